@@ -1,6 +1,6 @@
 #!/home/jon/code/smartplayer/env/bin/python
 import argparse
-from smartplayer.tracks import update_from_path
+from smartplayer.tracks import update_from_path, convert_track_db, TRACK_DB_BACKENDS
 from smartplayer import reporting
 from smartplayer import settings
 from smartplayer import players
@@ -8,7 +8,10 @@ from smartplayer import players
 REPORT_BY_TYPES = ['rating', 'listen_count', 'skip_count', 'date_added', 'date_played']
 
 def init_db(args):
-    update_from_path(args.directory, verbose=args.verbose, overwrite=args.overwrite, types=args.types.split(','))
+    update_from_path(args.directory, verbose=args.verbose, overwrite=args.overwrite, types=args.types.split(','), workers=args.workers)
+
+def convert_db(args):
+    convert_track_db(args.directory, args.to)
 
 def report_duplicates(args):
     reporting.report_duplicates(args.directory)
@@ -27,10 +30,13 @@ def report_by(args):
         print "Cannot prune items when using group by"
         return
 
-    report_by_func(args.directory, order=args.order, min_threshold=args.min_threshold, max_threshold=args.max_threshold, group_by=args.group_by, limit=args.limit, prune=args.prune, delete=args.delete, exclude=args.exclude)
+    report_by_func(args.directory, order=args.order, min_threshold=args.min_threshold, max_threshold=args.max_threshold, group_by=args.group_by, limit=args.limit, prune=args.prune, delete=args.delete, exclude=args.exclude, dry_run=args.dry_run)
+
+def report_stats(args):
+    reporting.report_stats(args.directory, group_by=args.group_by, fields=args.fields, sort=args.sort, order=args.order, limit=args.limit)
 
 def play(args):
-    players.play(args.directory, player=args.player, accepted_threshold=args.accepted_threshold, undecided_play_rate=args.undecided_rate, verbose=args.verbose)
+    players.play(args.directory, player=args.player, accepted_threshold=args.accepted_threshold, undecided_play_rate=args.undecided_rate, verbose=args.verbose, watch=args.watch, shuffle=args.shuffle)
 
 def main():
     parser = argparse.ArgumentParser(description="Manages and plays your music library")
@@ -45,11 +51,18 @@ def main():
     play_parser.add_argument('-p', '--player', default=settings.WRAPPER)
     play_parser.add_argument('-a', '--accepted-threshold', help="Rating threshold to consider a track accepted", default=settings.ACCEPTED_THRESHOLD)
     play_parser.add_argument('-u', '--undecided-rate', help="Percent of time to play undecided tracks", default=settings.UNDECIDED_PLAY_RATE)
+    play_parser.add_argument('-s', '--shuffle', choices=players.SmartPlayer.SHUFFLE_MODES, help="'pools' picks between accepted and undecided tracks, 'weighted' favours tracks by rating and play history", default=settings.SHUFFLE_MODE)
+    play_parser.add_argument('-w', '--watch', action='store_true', help="Pick up files added, removed or moved while playing", default=settings.WATCH_LIBRARY)
 
     init_parser = subparsers.add_parser('init', help="Initialize a new .tracks database in the current directory", parents=[common_parser])
     init_parser.set_defaults(func=init_db)
     init_parser.add_argument('-o', '--overwrite', help='Replace existing .tracks file', action='store_true')
     init_parser.add_argument('-t', '--types', help='File types to look at', default=','.join(settings.FILE_TYPES_TO_LOAD))
+    init_parser.add_argument('-w', '--workers', type=int, help='Number of processes reading tags, defaults to one per CPU', default=settings.SCAN_WORKERS)
+
+    convert_parser = subparsers.add_parser('convert', help="Convert the .tracks database to another storage backend", parents=[common_parser])
+    convert_parser.set_defaults(func=convert_db)
+    convert_parser.add_argument('--to', help="Backend to convert to", choices=TRACK_DB_BACKENDS, required=True)
 
     report_parser = subparsers.add_parser('report', help="Report on the .tracks in the current directory tree", parents=[common_parser])
     report_sub_parsers = report_parser.add_subparsers()
@@ -61,15 +74,24 @@ def main():
     report_missing_parser.set_defaults(func=report_missing)
     report_missing_parser.add_argument('-t', '--tags', help="Which tags to care about", default=','.join(settings.ID3_TAGS_TO_REPORT_MISSING))
 
+    report_stats_parser = report_sub_parsers.add_parser('stats', help="Count, sum, mean, min and max of several fields for each group of tracks")
+    report_stats_parser.set_defaults(func=report_stats)
+    report_stats_parser.add_argument('--group-by', help="Group tracks by the given fields, comma separated (artist,album), all tracks are one group without it")
+    report_stats_parser.add_argument('--fields', help="Fields to report on, comma separated", default=','.join(field for field, _ in reporting.STATS_FIELDS))
+    report_stats_parser.add_argument('--sort', help="Order groups by 'count' or a field's aggregate such as 'listen_count.sum'", default='count')
+    report_stats_parser.add_argument('--order', help="asc or desc", default="desc")
+    report_stats_parser.add_argument('--limit', type=int, help="Report a maximum number of groups")
+
     report_by_parser = argparse.ArgumentParser(add_help=False)
     report_by_parser.add_argument('--order', help="asc or desc", default="desc")
     report_by_parser.add_argument('--min-threshold', help="Report entries above this value")
     report_by_parser.add_argument('--max-threshold', help="Report entries below this value")
     report_by_parser.add_argument('--limit', type=int, help="Report a maximum number of entries")
-    report_by_parser.add_argument('--group-by', help="Group entry results by the given field (artist, album, etc.)")
+    report_by_parser.add_argument('--group-by', help="Group entry results by the given fields, comma separated (artist, album, etc.)")
     report_by_parser.add_argument('--prune', action="store_true", help="For each result prompt to remove or exclude")
     report_by_parser.add_argument('--exclude', action="store_true", help="Exclude each result from shuffle")
     report_by_parser.add_argument('--delete', action="store_true", help="Delete each result, USE WITH CAUTION")
+    report_by_parser.add_argument('--dry-run', action="store_true", help="Show what prune, exclude or delete would change without changing anything")
 
     # Add a parser for each thing we want to report by
     for name in REPORT_BY_TYPES:
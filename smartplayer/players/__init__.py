@@ -4,13 +4,22 @@ import datetime
 import json
 import random
 import os
+import time
 import argparse
+from collections import deque
 
 from smartplayer import settings
-from smartplayer.tracks import display_track, find_tracks_file
-from smartplayer.utils import MultiThreadObject, PersistedDict
+from smartplayer.tracks import display_track, find_tracks_file, open_track_db, load_id3_information, create_track_info, get_fingerprint, get_track_path_converter, ID3Exception
+from smartplayer.tracks.aggregates import TrackAggregates, aggregates_path
+from smartplayer.tracks.search import SearchIndex
+from smartplayer.tracks.watch import watch_library, ADDED, MOVED, REMOVED
+from smartplayer.utils import MultiThreadObject
+from smartplayer.utils.dates import DateConverter
+from smartplayer.utils.eventloop import EventLoopMixin
 
 from . import wrappers
+from .pools import TrackPool, WeightedTrackPool, RepeatWindow, make_track_weight
+from .prefetch import Prefetcher
 
 class SmartPlayer(MultiThreadObject):
     UP_VOTE = 1
@@ -32,7 +41,15 @@ class SmartPlayer(MultiThreadObject):
 
     DIGIT_COMMAND = 'play_search_result'
 
-    def __init__(self, db, wrapped_player, root_path=None, accepted_threshold=0, undecided_play_rate=10, verbose=False):
+    SHUFFLE_MODES = ['pools', 'weighted']
+
+    # Weights depend on how long ago tracks were played so they go stale
+    WEIGHT_REFRESH_INTERVAL = 60 * 60
+
+    # Nothing happens while paused, so there's no need to check on the player as often
+    PAUSED_TICK_INTERVAL = 5.0
+
+    def __init__(self, db, wrapped_player, root_path=None, accepted_threshold=0, undecided_play_rate=10, verbose=False, shuffle='pools'):
         super(SmartPlayer, self).__init__()
 
         self.wrapped_player = wrapped_player
@@ -50,27 +67,206 @@ class SmartPlayer(MultiThreadObject):
         self._current_track = None
         self.voted_on_current_track = False
         self.paused = False
-        self.accepted = {}
-        self.undecided = {}
-        self.excluded = {}
+        self.accepted = TrackPool()
+        self.undecided = TrackPool()
+        self.excluded = TrackPool()
+        self.weighted = None
+        self.recently_played = RepeatWindow({
+            'pk': settings.AVOID_REPEATING_TRACKS,
+            'artist': settings.AVOID_REPEATING_ARTISTS,
+            'album': settings.AVOID_REPEATING_ALBUMS,
+        })
+        self.weights_refreshed = time.time()
         self.playlist = []
         self.playlist_position = -1
+        self.upcoming = deque()
+        self.upcoming_size = max(settings.UPCOMING_TRACKS, 1)
+        self.prefetcher = None
         self.search_results = []
+        self.search_index = None
+        self.aggregates = None
+        self.library_watcher = None
+        self.vote_timer = None
 
-        for track_info in self.track_db.values():
-            tracks = self.accepted if track_info.get('rating', 0) >= accepted_threshold else self.undecided
-            groups = track_info.get('groups', [])
-            if any(exclusion in groups for exclusion in settings.EXCLUDED_SHUFFLE_GROUPS):
-                tracks = self.excluded
+        if self.wrapped_player.pushes_events:
+            self.wrapped_player.add_listener(self.__tick__)
 
-            tracks[track_info['pk']] = track_info
+        if shuffle == 'weighted':
+            self.weighted = WeightedTrackPool(settings.SHUFFLE_WEIGHT or make_track_weight(settings.DATE_FORMAT))
+
+        track_values = self.track_db.values()
+        for track_info in track_values:
+            self.add_to_pool(track_info)
 
-        if self.accepted:
+        # The totals are only worked out again once a track changes, if they weren't saved for this DB
+        db_path = self.track_db.file_path
+        dates = DateConverter(settings.DATE_FORMAT)
+        self.aggregates = TrackAggregates.load(aggregates_path(db_path), db_path, dates, source=self.track_db.values) or TrackAggregates(dates, source=self.track_db.values)
+
+        if settings.PREFETCH_UPCOMING:
+            self.prefetcher = Prefetcher()
+            self.prefetcher.start()
+
+        if self.accepted or self.weighted:
             self.next()
         else:
             print "No acceptable tracks found"
             self.stop()
 
+    def add_to_pool(self, track_info):
+        tracks = self.accepted if track_info.get('rating', 0) >= self.accepted_threshold else self.undecided
+        groups = track_info.get('groups', [])
+        if any(exclusion in groups for exclusion in settings.EXCLUDED_SHUFFLE_GROUPS):
+            tracks = self.excluded
+
+        if tracks is self.excluded:
+            tracks[track_info['pk']] = track_info
+            return
+
+        self.recently_played.add_track(track_info)
+        self.move_to_pool(track_info, tracks)
+
+        if self.weighted is not None:
+            self.move_to_pool(track_info, self.weighted)
+
+    def move_to_pool(self, track, to_group, from_group=None):
+        if from_group is not None:
+            del from_group[track['pk']]
+
+        to_group[track['pk']] = track
+
+        if self.recently_played.is_held(track['pk']):
+            to_group.hide(track['pk'])
+
+    def remove_from_pools(self, pk):
+        removed = None
+
+        for tracks in (self.accepted, self.undecided, self.excluded, self.weighted):
+            if tracks is not None and pk in tracks:
+                removed = tracks.pop(pk)
+
+        if removed is not None:
+            self.recently_played.remove_track(removed)
+
+    def hold_tracks(self, pks):
+        # Hide or show each track in whichever pools it's in to match the repeat window
+        for pk in pks:
+            held = self.recently_played.is_held(pk)
+
+            for tracks in (self.accepted, self.undecided, self.weighted):
+                if tracks is not None and pk in tracks:
+                    if held:
+                        tracks.hide(pk)
+                    else:
+                        tracks.unhide(pk)
+
+    def track_changed(self, track):
+        # The weighted shuffle needs to know about anything that affects a track's weight
+        if self.weighted is not None:
+            self.weighted.update(track['pk'])
+
+        # The current track can still be voted on or counted after it's been removed from the DB
+        if track['pk'] in self.track_db:
+            self.aggregates.add(track)
+
+    def watch_directory(self, types):
+        '''
+        Keeps the DB and the shuffle pools up to date with files being added, removed
+        or moved under root_path while playing. Tags are read on the watcher's thread,
+        the changes themselves are made on the main thread.
+        '''
+
+        to_key = get_track_path_converter(self.track_db, self.root_path)
+
+        def library_changed(event, file_path, old_file_path):
+            if event == ADDED:
+                try:
+                    id3_info = load_id3_information(file_path)
+                    fingerprint = get_fingerprint(file_path)
+                except (ID3Exception, OSError), e:
+                    self.log(e)
+                    return
+
+                self.execute_on_main_thread(self.track_added, [to_key(file_path), id3_info, fingerprint])
+            elif event == MOVED:
+                self.execute_on_main_thread(self.track_moved, [to_key(old_file_path), to_key(file_path)])
+            elif event == REMOVED:
+                self.execute_on_main_thread(self.track_removed, [to_key(file_path)])
+
+        self.library_watcher = watch_library(self.root_path, types, library_changed)
+
+    def track_added(self, pk, id3_info, fingerprint):
+        if pk in self.track_db:
+            self.log("updating tags for '%s'" % pk)
+            track = self.track_db[pk]
+
+            # The artist or album might have changed, which changes what holds it back
+            self.recently_played.remove_track(track)
+            track.update(id3_info, fingerprint=fingerprint)
+            if pk in self.accepted or pk in self.undecided:
+                self.recently_played.add_track(track)
+            self.hold_tracks([pk])
+
+            if self.search_index is not None:
+                self.search_index.add(track)
+            self.track_changed(track)
+        else:
+            self.log("adding '%s'" % pk)
+            date_added = datetime.datetime.now().strftime(settings.DATE_FORMAT)
+            self.track_db[pk] = create_track_info(pk, id3_info, date_added, fingerprint)
+            self.add_to_pool(self.track_db[pk])
+            if self.search_index is not None:
+                self.search_index.add(self.track_db[pk])
+            self.aggregates.add(self.track_db[pk])
+
+        self.track_db.save()
+
+    def track_moved(self, old_pk, pk):
+        if old_pk not in self.track_db:
+            return
+
+        self.log("moving '%s' to '%s'" % (old_pk, pk))
+        old_track = self.track_db[old_pk]
+        self.track_db[pk] = dict(old_track, pk=pk, file_path=pk)
+        del self.track_db[old_pk]
+        self.track_db.save()
+
+        track = self.track_db[pk]
+        self.remove_from_pools(old_pk)
+        self.add_to_pool(track)
+        if self.search_index is not None:
+            self.search_index.remove(old_pk)
+            self.search_index.add(track)
+        self.aggregates.remove(old_pk)
+        self.aggregates.add(track)
+
+        # Don't restart the current track, just make sure we hold on to the new one
+        self.playlist = [track if item is old_track else item for item in self.playlist]
+        self.upcoming = deque(track if item is old_track else item for item in self.upcoming)
+        if self._current_track is old_track:
+            self._current_track = track
+
+    def track_removed(self, pk):
+        # A removed directory takes everything under it along with it
+        if pk in self.track_db:
+            removed = [pk]
+        else:
+            removed = [key for key in self.track_db.keys() if key.startswith(pk + '/')]
+
+        for key in removed:
+            self.log("removing '%s'" % key)
+            del self.track_db[key]
+            self.remove_from_pools(key)
+            if self.search_index is not None:
+                self.search_index.remove(key)
+            self.aggregates.remove(key)
+
+        if removed:
+            self.track_db.save()
+
+            removed = set(removed)
+            self.upcoming = deque(track for track in self.upcoming if track['pk'] not in removed)
+
     def check_for_vote(self, stopped_playing=False):
         '''
         Looks at how far into the current track we are.
@@ -97,6 +293,35 @@ class SmartPlayer(MultiThreadObject):
         elif stopped_playing and (current >= time_for_down_vote or percentage >= amount_for_down_vote):
             self.down_vote()
 
+    def schedule_vote_check(self):
+        '''
+        When the wrapper pushes events we aren't ticking every second, so check for an
+        up vote at the moment the current track will have played long enough for one.
+        '''
+
+        if self.vote_timer:
+            self.vote_timer.cancel()
+            self.vote_timer = None
+
+        if not self.wrapped_player.pushes_events or self.paused or not self.current_track or self.voted_on_current_track:
+            return
+
+        time_for_up_vote, amount_for_up_vote = self.threshold_for_up_vote
+        due = min(time_for_up_vote, amount_for_up_vote * self.current_track['duration'])
+
+        # A little late is better than checking just before and having to wait for the next tick
+        delay = max(due - self.wrapped_player.position, 0) + 0.5
+        self.vote_timer = self.scheduler.call_later(delay, self.execute_on_main_thread, self.check_for_vote, None, self.TICK_PRIORITY, True)
+
+    def update_tick_interval(self):
+        if self.wrapped_player.pushes_events:
+            # Only poll now and then in case an event goes missing
+            self.set_tick_interval(settings.EVENT_FALLBACK_TICK_INTERVAL)
+        elif self.paused:
+            self.set_tick_interval(self.PAUSED_TICK_INTERVAL)
+        else:
+            self.set_tick_interval(self.TICK_INTERVAL)
+
     def up_vote(self):
         self.vote(self.current_track, self.UP_VOTE)
     def down_vote(self):
@@ -126,6 +351,7 @@ class SmartPlayer(MultiThreadObject):
         # Update the tracks rating and save to the DB
         track['rating'] += accepted_change if track['pk'] in self.accepted else undecided_change
         self.track_db.save()
+        self.track_changed(track)
         self.log("rating: %d" % int(track['rating']))
 
         # Move the track if it has crossed the threshold for being Accepted
@@ -141,11 +367,11 @@ class SmartPlayer(MultiThreadObject):
             self.log('demoting track to undecided')
 
         if from_group and to_group:
-            del from_group[track['pk']]
-            to_group[track['pk']] = track
+            self.move_to_pool(track, to_group, from_group)
 
     def play(self, direction, skip=False):
         self.paused = False
+        self.update_tick_interval()
 
         if not skip:
             self.check_for_vote(stopped_playing=True)
@@ -159,24 +385,67 @@ class SmartPlayer(MultiThreadObject):
             self.playlist_position += 1
 
             if self.playlist_position == len(self.playlist):
+                self.playlist.append(self.next_upcoming_track())
 
-                # Decide if we are playing new music or not
-                if random.random() <= self.undecided_play_rate:
-                    tracks = self.undecided
+        self.current_track = self.playlist[self.playlist_position]
+        self.log("rating: %d" % self.current_track.get('rating', 0))
 
-                    if not tracks:
-                        tracks = self.accepted
-                else:
-                    tracks = self.accepted
+    def next_upcoming_track(self):
+        '''
+        Tracks are picked a few ahead of time so the files can be read in before
+        they're needed. Returns the next one and picks another to replace it.
+        '''
 
-                next_track = tracks[random.choice(tracks.keys())]
-                self.playlist.append(next_track)
+        self.fill_upcoming()
+        track = self.upcoming.popleft()
+        self.fill_upcoming()
 
-        self.current_track = self.playlist[self.playlist_position]
-        self.log("rating: %d" % self.current_track.get('rating', 0))
+        return track
+
+    def fill_upcoming(self):
+        while len(self.upcoming) < self.upcoming_size:
+            track = self.pick_next_track()
+            self.upcoming.append(track)
+            self.queued(track)
+
+            if self.prefetcher:
+                self.prefetcher.prefetch(os.path.join(self.root_path, track['file_path']))
+
+    def queued(self, track):
+        # Count tracks against repeats once they're lined up, so the ones waiting aren't picked again
+        held, released = self.recently_played.played(track)
+        self.hold_tracks(held + released)
+
+    def pick_next_track(self):
+        if self.weighted is not None:
+            if time.time() - self.weights_refreshed > self.WEIGHT_REFRESH_INTERVAL:
+                self.weighted.refresh()
+                self.weights_refreshed = time.time()
+
+            return self.weighted.choice()
+
+        # Decide if we are playing new music or not
+        if random.random() <= self.undecided_play_rate:
+            tracks = self.undecided
+
+            if not tracks.available():
+                tracks = self.accepted
+        else:
+            tracks = self.accepted
+
+        return tracks.choice()
 
     def play_track(self, track):
         self.playlist.append(track)
+
+        # A track already lined up has been counted against repeats, it just shouldn't play twice
+        upcoming = deque(item for item in self.upcoming if item['pk'] != track['pk'])
+        if len(upcoming) < len(self.upcoming):
+            self.upcoming = upcoming
+            self.fill_upcoming()
+        else:
+            self.queued(track)
+
         self.skip()
 
     def skip(self):
@@ -199,32 +468,37 @@ class SmartPlayer(MultiThreadObject):
     def toggle_pause(self):
         self.paused = not self.paused
         self.wrapped_player.toggle_pause()
+        self.schedule_vote_check()
+        self.update_tick_interval()
 
     def search(self, search_text):
         if not search_text:
             return
 
-        tokens = search_text.lower().split()
-
-        candidates = self.track_db.values()
-
-        for token in tokens:
-            remaining_candidates = []
-
-            for track in candidates:
-                if any(track.get(field) and token in track[field].lower() for field in ['artist', 'album', 'title']):
-                    remaining_candidates.append(track)
+        if self.search_index is None:
+            # Only read (or built) the first time it's needed, it catches up with any changes made before then
+            self.search_index = SearchIndex.load(self.track_db.file_path + '.search', self.track_db.values(), fuzzy=settings.SEARCH_FUZZY, min_similarity=settings.SEARCH_FUZZY_SIMILARITY)
 
-            candidates = remaining_candidates
-
-            if not remaining_candidates:
-                break
-
-        self.search_results = remaining_candidates
+        self.search_results = self.search_index.search(search_text, limit=settings.SEARCH_RESULT_LIMIT)
 
         for i, track in enumerate(self.search_results):
             print "%d. %s" % (i + 1, display_track(track))
 
+    def save_search_index(self):
+        if self.search_index is not None and self.search_index.changed:
+            try:
+                self.search_index.save(self.track_db.file_path + '.search')
+            except (IOError, OSError), e:
+                # It'll just be built again next time
+                self.log(e)
+
+    def save_aggregates(self):
+        try:
+            self.aggregates.save(aggregates_path(self.track_db.file_path), self.track_db.file_path)
+        except (IOError, OSError), e:
+            # Reports will work them out from the tracks instead
+            self.log(e)
+
     def play_search_result(self, number):
         if len(self.search_results) >= number:
             self.play_track(self.search_results[number - 1])
@@ -233,6 +507,18 @@ class SmartPlayer(MultiThreadObject):
 
     def stop(self):
         print "Closing..."
+        if self.vote_timer:
+            self.vote_timer.cancel()
+        if self.library_watcher:
+            self.library_watcher.stop()
+        if self.prefetcher:
+            self.prefetcher.stop()
+        self.save_search_index()
+        self.track_db.close()
+
+        # Saved after the DB's last write so reports know they match it
+        if self.aggregates.changed:
+            self.save_aggregates()
         self.wrapped_player.close()
 
     def tick(self):
@@ -249,24 +535,29 @@ class SmartPlayer(MultiThreadObject):
         track['listen_count'] = track.get('listen_count', 0) + 1
         track['date_played'] = datetime.datetime.now().strftime(settings.DATE_FORMAT)
         self.track_db.save()
+        self.track_changed(track)
 
     def incr_skip_count(self, track):
         track['skip_count'] = track.get('skip_count', 0) + 1
         self.track_db.save()
+        self.track_changed(track)
 
     def set_current_track(self, track):
         self.voted_on_current_track = False
         self._current_track = track
         self.wrapped_player.play(os.path.join(self.root_path, track['file_path']))
         print "Now Playing: %s" % display_track(track)
+        self.schedule_vote_check()
 
     def get_current_track(self):
         return self._current_track
 
     current_track = property(get_current_track, set_current_track)
 
+class EventLoopSmartPlayer(EventLoopMixin, SmartPlayer):
+    pass
 
-def play(path, player=None, accepted_threshold=None, undecided_play_rate=None, verbose=False):
+def play(path, player=None, accepted_threshold=None, undecided_play_rate=None, verbose=False, watch=False, shuffle='pools'):
     wrapper_cls = getattr(wrappers, player, None)
 
     if not wrapper_cls:
@@ -277,6 +568,10 @@ def play(path, player=None, accepted_threshold=None, undecided_play_rate=None, v
         tracks_file = find_tracks_file(path)
         root_path = tracks_file.rpartition('/')[0]
 
-        player = SmartPlayer(PersistedDict(tracks_file), wrapped_player, root_path=root_path, accepted_threshold=accepted_threshold, undecided_play_rate=undecided_play_rate, verbose=verbose)
+        player_cls = EventLoopSmartPlayer if settings.PLAYER_RUNTIME == 'event_loop' else SmartPlayer
+        player = player_cls(open_track_db(tracks_file, save_delay=settings.TRACK_DB_SAVE_DELAY), wrapped_player, root_path=root_path, accepted_threshold=accepted_threshold, undecided_play_rate=undecided_play_rate, verbose=verbose, shuffle=shuffle)
+
+        if watch:
+            player.watch_directory(settings.FILE_TYPES_TO_LOAD)
 
         player.start()
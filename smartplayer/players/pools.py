@@ -0,0 +1,336 @@
+import random
+from collections import deque
+
+from smartplayer.utils.dates import DateConverter
+
+class TrackPool(object):
+    '''
+    A dict-like collection of tracks keyed by pk that can also pick a random track in
+    constant time, where random.choice(tracks.keys()) has to build a list of every key.
+
+    Entries are kept in a list alongside a map of pk to position in that list.
+    Removing one moves the last entry into its place so the list never has gaps,
+    which keeps adding, removing and picking all O(1).
+
+    Hidden tracks stay in the pool but aren't picked. They're kept at the end of the
+    list, after the first `visible` entries, so hiding and unhiding are swaps too.
+    '''
+
+    def __init__(self):
+        self.entries = []
+        self.positions = {}
+        self.visible = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __nonzero__(self):
+        return bool(self.entries)
+
+    def __contains__(self, pk):
+        return pk in self.positions
+
+    def __iter__(self):
+        return (pk for pk, _ in self.entries)
+
+    def __getitem__(self, pk):
+        return self.entries[self.positions[pk]][1]
+
+    def __setitem__(self, pk, track):
+        if pk in self.positions:
+            self.entries[self.positions[pk]] = (pk, track)
+        else:
+            self.positions[pk] = len(self.entries)
+            self.entries.append((pk, track))
+            self.swap(len(self.entries) - 1, self.visible)
+            self.visible += 1
+
+    def __delitem__(self, pk):
+        if self.positions[pk] < self.visible:
+            self.visible -= 1
+            self.swap(self.positions[pk], self.visible)
+
+        self.swap(self.positions[pk], len(self.entries) - 1)
+
+        del self.positions[pk]
+        self.entries.pop()
+
+    def swap(self, position, other):
+        if position != other:
+            entries = self.entries
+            entries[position], entries[other] = entries[other], entries[position]
+            self.positions[entries[position][0]] = position
+            self.positions[entries[other][0]] = other
+
+    def hide(self, pk):
+        if self.positions[pk] < self.visible:
+            self.visible -= 1
+            self.swap(self.positions[pk], self.visible)
+
+    def unhide(self, pk):
+        if self.positions[pk] >= self.visible:
+            self.swap(self.positions[pk], self.visible)
+            self.visible += 1
+
+    def available(self):
+        return self.visible
+
+    def pop(self, pk, *default):
+        if pk not in self.positions:
+            if default:
+                return default[0]
+            raise KeyError(pk)
+
+        track = self[pk]
+        del self[pk]
+        return track
+
+    def keys(self):
+        return [pk for pk, _ in self.entries]
+
+    def values(self):
+        return [track for _, track in self.entries]
+
+    def choice(self):
+        # With everything hidden any track is better than none
+        return self.entries[random.randrange(self.visible or len(self.entries))][1]
+
+class WeightedTrackPool(TrackPool):
+    '''
+    A TrackPool where choice() picks tracks with probability proportional to
+    weight(track).
+
+    Weights are kept in a Fenwick tree over the entry positions, so both picking a
+    track and changing one track's weight are O(log n). Call update() after changing
+    a track so its weight is recalculated, or refresh() to recalculate them all.
+    Hidden tracks are given no weight rather than being moved out of the way.
+    '''
+
+    def __init__(self, weight):
+        super(WeightedTrackPool, self).__init__()
+        self.weight = weight
+        self.weights = []
+        self.tree = [0.0]
+        self.hidden = set()
+
+    def track_weight(self, track):
+        if track['pk'] in self.hidden:
+            return 0.0
+
+        return max(float(self.weight(track)), 0.0)
+
+    def add_to_tree(self, position, delta):
+        i = position + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def set_weight(self, position, weight):
+        self.add_to_tree(position, weight - self.weights[position])
+        self.weights[position] = weight
+
+    def rebuild(self, capacity):
+        self.tree = [0.0] * (capacity + 1)
+        self.tree[1:len(self.weights) + 1] = self.weights
+
+        # Every node has to pass its sum on, including the empty ones past the last weight
+        for i in xrange(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                self.tree[parent] += self.tree[i]
+
+    def refresh(self):
+        self.weights = [self.track_weight(track) for _, track in self.entries]
+        self.rebuild(len(self.tree) - 1)
+
+    def update(self, pk):
+        if pk in self.positions:
+            self.set_weight(self.positions[pk], self.track_weight(self[pk]))
+
+    def __setitem__(self, pk, track):
+        if pk not in self.positions:
+            self.weights.append(0.0)
+
+            # Grow by doubling so appends stay cheap on average
+            if len(self.weights) >= len(self.tree):
+                self.rebuild(max(16, 2 * len(self.weights)))
+
+        super(WeightedTrackPool, self).__setitem__(pk, track)
+        self.set_weight(self.positions[pk], self.track_weight(track))
+
+    def __delitem__(self, pk):
+        position = self.positions[pk]
+        last = len(self.entries) - 1
+
+        if position != last:
+            self.set_weight(position, self.weights[last])
+        self.set_weight(last, 0.0)
+        self.weights.pop()
+        self.hidden.discard(pk)
+
+        super(WeightedTrackPool, self).__delitem__(pk)
+
+    def hide(self, pk):
+        self.hidden.add(pk)
+        self.update(pk)
+
+    def unhide(self, pk):
+        self.hidden.discard(pk)
+        self.update(pk)
+
+    def available(self):
+        return len(self.entries) - len(self.hidden)
+
+    def total(self):
+        total = 0.0
+        i = len(self.weights)
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+
+        return total
+
+    def choice(self):
+        total = self.total()
+
+        # Nothing has any weight, fall back to picking evenly
+        if total <= 0:
+            return super(WeightedTrackPool, self).choice()
+
+        # Walk down the tree to the first position where the running total passes value
+        value = random.random() * total
+        position = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+
+        while step:
+            next_position = position + step
+            if next_position < len(self.tree) and self.tree[next_position] <= value:
+                position = next_position
+                value -= self.tree[next_position]
+            step >>= 1
+
+        # Rounding can walk off the end or onto an empty slot, the last weighted one is closest
+        position = min(position, len(self.entries) - 1)
+        while position > 0 and not self.weights[position]:
+            position -= 1
+
+        return self.entries[position][1]
+
+class RepeatWindow(object):
+    '''
+    Remembers the last few values of each field in sizes (e.g. {'pk': 20, 'artist': 2})
+    that were played and which tracks they rule out, so those can be hidden in the
+    pools instead of picking again until something else comes up.
+
+    Tracks are indexed by each field's value, so playing a track only touches the
+    tracks that share its values and the cost doesn't depend on the window sizes.
+    A track is held for as long as any of its values are in a window.
+    '''
+
+    def __init__(self, sizes):
+        self.sizes = dict((field, size) for field, size in sizes.iteritems() if size > 0)
+        self.recent = dict((field, deque()) for field in self.sizes)
+        self.counts = dict((field, {}) for field in self.sizes)
+        self.tracks_by = dict((field, {}) for field in self.sizes)
+        self.held = {}
+
+    def __nonzero__(self):
+        return bool(self.sizes)
+
+    def is_held(self, pk):
+        return pk in self.held
+
+    def add_track(self, track):
+        '''
+        Indexes track, returning whether it's currently held.
+        '''
+
+        held = 0
+        for field in self.sizes:
+            value = track.get(field)
+            if value is not None:
+                self.tracks_by[field].setdefault(value, set()).add(track['pk'])
+                held += self.counts[field].get(value, 0)
+
+        if held:
+            self.held[track['pk']] = self.held.get(track['pk'], 0) + held
+
+        return bool(held)
+
+    def remove_track(self, track):
+        for field in self.sizes:
+            pks = self.tracks_by[field].get(track.get(field))
+            if pks:
+                pks.discard(track['pk'])
+                if not pks:
+                    del self.tracks_by[field][track.get(field)]
+
+        self.held.pop(track['pk'], None)
+
+    def played(self, track):
+        '''
+        Moves the windows along for track being played. Returns the pks that became
+        held and the ones that were released.
+        '''
+
+        held = []
+        released = []
+
+        for field, size in self.sizes.iteritems():
+            value = track.get(field)
+            if value is None:
+                continue
+
+            recent = self.recent[field]
+            counts = self.counts[field]
+            recent.append(value)
+            counts[value] = counts.get(value, 0) + 1
+            for pk in self.tracks_by[field].get(value, ()):
+                self.held[pk] = self.held.get(pk, 0) + 1
+                if self.held[pk] == 1:
+                    held.append(pk)
+
+            if len(recent) > size:
+                value = recent.popleft()
+                counts[value] -= 1
+                if not counts[value]:
+                    del counts[value]
+
+                for pk in self.tracks_by[field].get(value, ()):
+                    self.held[pk] -= 1
+                    if not self.held[pk]:
+                        del self.held[pk]
+                        released.append(pk)
+
+        return held, released
+
+def make_track_weight(date_format, rating_scale=100.0, replay_days=7.0):
+    '''
+    The default weight for the weighted shuffle. It doubles for every rating_scale
+    points of rating, is scaled by the share of plays that weren't skipped, and
+    for a track played in the last replay_days grows from near nothing back to full.
+    '''
+
+    dates = DateConverter(date_format)
+
+    def weight(track):
+        rating = max(min(track.get('rating', 0) / rating_scale, 50), -50)
+        listens = track.get('listen_count', 0)
+        skips = track.get('skip_count', 0)
+
+        value = 2 ** rating
+        value *= (listens + 1.0) / (listens + skips + 1.0)
+
+        if track.get('date_played'):
+            try:
+                played = dates(track['date_played'])
+            except ValueError:
+                played = None
+
+            if played is not None:
+                days = (dates.now() - played) / 86400.0
+                value *= min(max(days / replay_days, 0.01), 1.0)
+
+        return value
+
+    return weight
@@ -0,0 +1,56 @@
+from collections import deque
+from Queue import Queue
+from threading import Thread
+
+class Prefetcher(Thread):
+    '''
+    Reads files that are about to be played on a background thread so they're already
+    in the OS page cache when the player opens them, which hides the delay of slow
+    disks and network mounts between tracks. Call prefetch(file_path) for each file
+    coming up and stop() when done.
+    '''
+
+    CHUNK_SIZE = 1024 * 1024
+
+    # Files read recently enough that they're probably still cached
+    REMEMBERED = 16
+
+    def __init__(self, max_bytes=None):
+        super(Prefetcher, self).__init__()
+        self.daemon = True
+        self.max_bytes = max_bytes
+        self.requests = Queue()
+        self.prefetched = deque(maxlen=self.REMEMBERED)
+        self.stopped = False
+
+    def prefetch(self, file_path):
+        self.requests.put(file_path)
+
+    def read(self, file_path):
+        read = 0
+
+        try:
+            with open(file_path, 'rb') as f:
+                while not self.stopped and (self.max_bytes is None or read < self.max_bytes):
+                    chunk = f.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    read += len(chunk)
+        except (IOError, OSError):
+            # The player will report it properly when it gets there
+            pass
+
+    def run(self):
+        while True:
+            file_path = self.requests.get()
+            if file_path is None:
+                break
+
+            if file_path not in self.prefetched:
+                self.read(file_path)
+                self.prefetched.append(file_path)
+
+    def stop(self):
+        self.stopped = True
+        self.requests.put(None)
+        self.join()
@@ -1,7 +1,23 @@
 class PlayerWrapper(object):
+    # Wrappers that call state_changed() whenever the player starts, stops or pauses
+    # set this, so the player doesn't have to keep polling them
+    pushes_events = False
 
     def __init__(self):
         super(PlayerWrapper, self).__init__()
+        self.listeners = []
+
+    def add_listener(self, listener):
+        '''
+        listener() is called, possibly from another thread, whenever the player's
+        state might have changed.
+        '''
+
+        self.listeners.append(listener)
+
+    def state_changed(self, *args):
+        for listener in self.listeners:
+            listener()
 
     @property
     def position(self):
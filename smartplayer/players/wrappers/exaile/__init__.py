@@ -1,8 +1,15 @@
 import os
 import dbus
 import time
+from threading import Thread
 from ..base import PlayerWrapper
 
+try:
+    import gobject
+    from dbus.mainloop.glib import DBusGMainLoop, threads_init
+except ImportError:
+    gobject = None
+
 def retry(max_attempts):
     '''
     DBus calls can be unreliable, every now and then one will just fail
@@ -30,12 +37,29 @@ class ExaileWrapper(PlayerWrapper):
 
     def __init__(self):
         super(ExaileWrapper, self).__init__()
-        bus = dbus.SessionBus()
+        self.event_loop = None
+
+        if gobject:
+            # Signals are delivered by a GLib main loop, which runs on its own thread
+            gobject.threads_init()
+            threads_init()
+            bus = dbus.SessionBus(mainloop=DBusGMainLoop())
+        else:
+            bus = dbus.SessionBus()
+
         bus.start_service_by_name('org.exaile.Exaile')
         obj = bus.get_object('org.exaile.Exaile', '/org/exaile/Exaile')
 
         self.media_player = dbus.Interface(obj, 'org.exaile.Exaile')
 
+        if gobject:
+            self.media_player.connect_to_signal('StateChanged', self.state_changed)
+            self.event_loop = gobject.MainLoop()
+            event_thread = Thread(target=self.event_loop.run)
+            event_thread.daemon = True
+            event_thread.start()
+            self.pushes_events = True
+
     @property
     @retry(max_attempts=10)
     def position(self):
@@ -58,4 +82,7 @@ class ExaileWrapper(PlayerWrapper):
         self.media_player.PlayPause()
 
     def close(self):
+        if self.event_loop:
+            self.event_loop.quit()
+
         os.system("killall -9 exaile")
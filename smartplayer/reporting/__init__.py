@@ -1,11 +1,24 @@
 import datetime
 import os
 from smartplayer import settings
-from smartplayer.tracks import get_track_key, get_track_info, display_track
-from smartplayer.utils import PersistedDict
+from smartplayer.tracks import get_track_key, get_track_info, display_track, open_track_db, find_tracks_file
+from smartplayer.tracks.aggregates import TrackAggregates, GROUP_FIELDS, FIGURES, aggregates_path, db_stamp
+from smartplayer.utils.dates import DATE_FIELDS, DateConverter
+from smartplayer.utils.sqlite import SqliteDict
+
+from .columns import TrackColumns, AGGREGATES, group_stats
 
 MIN_DATE = datetime.datetime(1900, 1, 1).strftime(settings.DATE_FORMAT)
 
+# Fields report_stats can work out figures for and what to call them
+STATS_FIELDS = [
+    ('rating', "Rating"),
+    ('listen_count', "Listen Count"),
+    ('skip_count', "Skip Count"),
+    ('date_added', "Date Added"),
+    ('date_played', "Date Played"),
+]
+
 def report_duplicates(path):
     id3_info = {}
     for track_info in get_track_info(path):
@@ -25,63 +38,97 @@ def report_missing(path, tags=None):
         if missing_fields:
             print "%s\tMissing fields: %s" % (track_info['pk'], ', '.join(missing_fields))
 
-def report_by(path, field, friendly_name, aggregate_func=None, convert_func=None, default=None, order='desc', group_by=None, min_threshold=None, max_threshold=None, limit=None, prune=False, delete=False, exclude=False):
-
-    # Sort the result
-    def key_func(item):
-        key = item.get(field, default)
-        if convert_func:
-            key = convert_func(key)
+def report_by(path, field, friendly_name, aggregate=None, convert_func=None, format_func=None, default=None, order='desc', group_by=None, min_threshold=None, max_threshold=None, limit=None, prune=False, delete=False, exclude=False, dry_run=False):
+    '''
+    convert_func turns a value of field into a number to order by and format_func
+    turns a number back into a value for display. Groups are ordered by the
+    aggregate ('sum' or 'max') of their tracks' numbers. group_by is a list of
+    fields or a comma separated string of them.
+    '''
 
-        return key
+    group_by = split_fields(group_by)
 
-    tracks = get_track_info(path)
+    try:
+        tracks_file = find_tracks_file(path)
+    except Exception, e:
+        tracks_file = None
+        print e
 
-    # Deal with grouping
-    if group_by:
-        groups = {}
+    # The player keeps totals for each artist and album so these don't need to read any tracks
+    materialized = tracks_file and group_by and len(group_by) == 1 and group_by[0] in GROUP_FIELDS and FIGURES.get(field, (None, None))[1] == aggregate
+    aggregates = None
+    if materialized:
+        aggregates = TrackAggregates.load(aggregates_path(tracks_file), tracks_file, DateConverter(settings.DATE_FORMAT))
 
-        for track_info in tracks:
-            group_key = track_info.get(group_by)
-            groups.setdefault(group_key, {})
-            groups[group_key][field] = aggregate_func(key_func(groups[group_key]), key_func(track_info))
-            groups[group_key][group_by] = group_key
+    db = None
+    if aggregates is None and tracks_file:
+        stamp = db_stamp(tracks_file)
+        try:
+            db = open_track_db(tracks_file)
+        except Exception, e:
+            print e
 
-        tracks = groups.values()
+    if isinstance(db, SqliteDict) and not group_by:
+        # Let the DB do the filtering and sorting on its indexed columns
+        def db_value(value):
+            if value is None or field in DATE_FIELDS:
+                return value
+            return convert_func(value)
 
-    result = sorted(tracks, key=key_func, reverse=(order == 'desc'))
+        result = db.select(field, default=default, reverse=(order == 'desc'), min_value=db_value(min_threshold), max_value=db_value(max_threshold), limit=limit)
+    else:
+        if aggregates is not None:
+            columns = TrackColumns.load(aggregates.rows(group_by[0], field), field, convert_func, default=default)
+        else:
+            tracks = db.values() if db is not None else []
+            columns = TrackColumns.load(tracks, field, convert_func, default=default, group_by=group_by)
 
-    # Deal with thresholds
-    if min_threshold or max_threshold:
-        limited_result = []
-        for item in result:
-            if min_threshold and key_func(item) < convert_func(min_threshold):
-                continue
-            if max_threshold and key_func(item) > convert_func(max_threshold):
-                continue
+            if materialized and db is not None:
+                # Having read every track anyway, save the totals for next time
+                try:
+                    TrackAggregates(DateConverter(settings.DATE_FORMAT), tracks).save(aggregates_path(tracks_file), tracks_file, stamp=stamp)
+                except (IOError, OSError), e:
+                    print e
 
-            limited_result.append(item)
+            # Deal with grouping
+            if group_by:
+                def make_row(key, value):
+                    row = dict(zip(group_by, key))
+                    row[field] = format_func(value)
+                    return row
 
-        result = limited_result
+                columns = columns.aggregate(aggregate, make_row)
 
-    if limit:
-        result = result[:limit]
+        result = columns.select(
+            min_value=convert_func(min_threshold) if min_threshold else None,
+            max_value=convert_func(max_threshold) if max_threshold else None,
+            reverse=(order == 'desc'),
+            limit=limit,
+        )
 
     if prune or delete or exclude:
         if group_by:
             return
 
-        db = PersistedDict(os.path.join(path, '.tracks'))
+        to_exclude = []
+        to_delete = []
+
         for item in result:
             action = None
             if prune:
                 prompt = "%s\nDelete this track? (y)es/(n)o/(e)xclude from shuffle\n" % display_track(item)
                 prompt = prompt.encode("ascii", "ignore")
 
-                while True:
-                    ans = raw_input(prompt)
-                    if ans in ['y', 'n', 'e']:
-                        break
+                try:
+                    while True:
+                        ans = raw_input(prompt)
+                        if ans in ['y', 'n', 'e']:
+                            break
+                except (KeyboardInterrupt, EOFError):
+                    # Stop asking but keep the answers given so far
+                    print
+                    break
+
                 if ans == 'y':
                     action = 'delete'
                 elif ans == 'e':
@@ -92,23 +139,17 @@ def report_by(path, field, friendly_name, aggregate_func=None, convert_func=None
                 action = 'delete'
 
             if action == 'exclude':
-                track_info = db[item['pk']]
-                track_groups = track_info.get('groups', [])
-                if 'exclude' not in track_groups:
-                    track_groups.append('exclude')
-                track_info['groups'] = track_groups
-                db.save()
+                to_exclude.append(item)
             elif action == 'delete':
-                del db[item['pk']]
-                db.save()
-                os.remove(os.path.join(path, item['file_path']))
+                to_delete.append(item)
+
+        # Track paths are relative to the directory the DB is in, not the one given
+        apply_changes(db, os.path.dirname(tracks_file), to_exclude, to_delete, dry_run=dry_run)
     else:
         # Just display
         for item in result:
             if group_by:
-                display = item[group_by]
-                if display is None:
-                    display = "<Unknown>"
+                display = display_group(item, group_by)
             else:
                 display = display_track(item)
 
@@ -119,6 +160,57 @@ def report_by(path, field, friendly_name, aggregate_func=None, convert_func=None
 
             print "%s,\t%s: %s" % (display, friendly_name, value)
 
+def split_fields(fields):
+    if isinstance(fields, basestring):
+        return [field.strip() for field in fields.split(',') if field.strip()]
+
+    return fields
+
+def display_group(item, group_by):
+    if not group_by:
+        return "All tracks"
+
+    return " - ".join("<Unknown>" if item[key] is None else "%s" % item[key] for key in group_by)
+
+def apply_changes(db, root_path, to_exclude, to_delete, dry_run=False):
+    '''
+    Excludes and deletes the given tracks with a single save of the DB, then removes
+    the deleted tracks' files from under root_path, the directory holding the DB.
+    With dry_run it only says what it would do.
+    '''
+
+    if dry_run:
+        for item in to_exclude:
+            print "Would exclude %s" % display_track(item)
+        for item in to_delete:
+            print "Would delete %s" % display_track(item)
+        print "Would exclude %d and delete %d tracks" % (len(to_exclude), len(to_delete))
+        return
+
+    for item in to_exclude:
+        track_info = db[item['pk']]
+        track_groups = track_info.get('groups', [])
+        if 'exclude' not in track_groups:
+            track_groups.append('exclude')
+        track_info['groups'] = track_groups
+
+    for item in to_delete:
+        del db[item['pk']]
+
+    if to_exclude or to_delete:
+        db.save()
+
+    # Only touch the files once the DB no longer refers to them
+    failed = 0
+    for item in to_delete:
+        try:
+            os.remove(os.path.join(root_path, item['file_path']))
+        except OSError, e:
+            print e
+            failed += 1
+
+    print "Excluded %d and deleted %d tracks" % (len(to_exclude), len(to_delete) - failed)
+
 def report_by_rating(path, **kwargs):
     report_by_int(path, "rating", "Rating", **kwargs)
 
@@ -135,8 +227,68 @@ def report_by_date_played(path, **kwargs):
     report_by_date(path, "date_played", "Date Played", **kwargs)
 
 def report_by_int(path, field, friendly_field, **kwargs):
-    report_by(path, field, friendly_field, default=0, aggregate_func=sum, convert_func=int, **kwargs)
+    report_by(path, field, friendly_field, default=0, aggregate='sum', convert_func=int, format_func=int, **kwargs)
 
 def report_by_date(path, field, friendly_field, **kwargs):
-    convert = lambda x: datetime.datetime.strptime(x, settings.DATE_FORMAT)
-    report_by(path, field, friendly_field, default=MIN_DATE, aggregate_func=max, convert_func=convert, **kwargs)
+    dates = DateConverter(settings.DATE_FORMAT)
+    report_by(path, field, friendly_field, default=MIN_DATE, aggregate='max', convert_func=dates, format_func=dates.format, **kwargs)
+
+def report_stats(path, group_by=None, fields=None, sort='count', order='desc', limit=None):
+    '''
+    Prints the number of tracks in each group along with the sum, mean, min and max
+    of each of fields, all worked out in one pass over the DB. Dates only get a min
+    and max. Without group_by the whole library is one group. Groups are ordered by
+    sort, either 'count' or 'field.aggregate' such as 'listen_count.sum'.
+    '''
+
+    group_by = split_fields(group_by) or []
+    fields = split_fields(fields) or [field for field, _ in STATS_FIELDS]
+    friendly_names = dict(STATS_FIELDS)
+
+    unknown = [field for field in fields if field not in friendly_names]
+    if unknown:
+        print "Invalid stats fields: %s" % ', '.join(unknown)
+        return
+
+    sort_field, _, sort_aggregate = sort.partition('.')
+    if sort != 'count' and (sort_field not in fields or sort_aggregate not in AGGREGATES):
+        print "Invalid sort: %s" % sort
+        return
+
+    dates = DateConverter(settings.DATE_FORMAT)
+
+    stats_fields = []
+    for field in fields:
+        if field in DATE_FIELDS:
+            stats_fields.append((field, dates, None))
+        else:
+            stats_fields.append((field, int, 0))
+
+    try:
+        db = open_track_db(find_tracks_file(path))
+    except Exception, e:
+        print e
+        return
+
+    rows = group_stats(db.itervalues(), group_by, stats_fields)
+
+    # Groups without a value to sort by go last
+    columns = TrackColumns.load(rows, sort, float, default=float('-inf') if order == 'desc' else float('inf'))
+    rows = columns.select(reverse=(order == 'desc'), limit=limit)
+
+    for row in rows:
+        parts = [display_group(row, group_by), "Tracks: %d" % row['count']]
+
+        for field in fields:
+            if field + '.count' not in row:
+                continue
+
+            if field in DATE_FIELDS:
+                figures = ["min %s" % dates.format(row[field + '.min']), "max %s" % dates.format(row[field + '.max'])]
+            else:
+                figures = ["sum %d" % row[field + '.sum'], "mean %.2f" % row[field + '.mean'],
+                           "min %d" % row[field + '.min'], "max %d" % row[field + '.max']]
+
+            parts.append("%s: %s" % (friendly_names[field], ', '.join(figures)))
+
+        print ",\t".join(parts)
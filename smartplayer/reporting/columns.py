@@ -0,0 +1,199 @@
+'''
+Column oriented evaluation for report_by.
+
+The one field a report looks at is pulled out of every track into a single array of
+numbers (dates as epoch seconds, parsed once each) and filtering, ordering and
+grouping work on that array and on arrays of row numbers instead of on the track
+dicts. NumPy is used when it's installed, otherwise the standard array module.
+'''
+
+import array
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class TrackColumns(object):
+    '''
+    rows[i] is the item (a track or a group) whose value is values[i].
+    groups[i] is the number of the group it belongs to in group_keys, if grouping.
+    Tracks are grouped by a list of fields, so each group key is a tuple of values.
+    '''
+
+    def __init__(self, rows, values, groups=None, group_keys=None):
+        self.rows = rows
+        self.values = values
+        self.groups = groups
+        self.group_keys = group_keys
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def load(cls, tracks, field, to_number, default=None, group_by=None):
+        rows = []
+        values = []
+        groups = []
+        group_keys = []
+        group_numbers = {}
+
+        for track in tracks:
+            rows.append(track)
+            values.append(to_number(track.get(field, default)))
+
+            if group_by:
+                key = tuple(track.get(key_field) for key_field in group_by)
+                if key not in group_numbers:
+                    group_numbers[key] = len(group_keys)
+                    group_keys.append(key)
+                groups.append(group_numbers[key])
+
+        if numpy is not None:
+            values = numpy.array(values, dtype=numpy.float64)
+            groups = numpy.array(groups, dtype=numpy.intp)
+        else:
+            values = array.array('d', values)
+            groups = array.array('l', groups)
+
+        return cls(rows, values, groups if group_by else None, group_keys if group_by else None)
+
+    def aggregate(self, how, make_row):
+        '''
+        Returns TrackColumns with a row per group made by make_row(key, value), where
+        value is the 'sum' or 'max' of the values in that group. Groups are in key
+        order, so groups with the same value always come out in the same order.
+        '''
+
+        count = len(self.group_keys)
+
+        if numpy is not None:
+            if how == 'sum':
+                values = numpy.bincount(self.groups, weights=self.values, minlength=count)
+            else:
+                values = numpy.full(count, -numpy.inf)
+                numpy.maximum.at(values, self.groups, self.values)
+        else:
+            if how == 'sum':
+                values = array.array('d', [0.0]) * count
+                for group, value in zip(self.groups, self.values):
+                    values[group] += value
+            else:
+                values = array.array('d', [float('-inf')]) * count
+                for group, value in zip(self.groups, self.values):
+                    if value > values[group]:
+                        values[group] = value
+
+        order = sorted(range(count), key=self.group_keys.__getitem__)
+        rows = [make_row(self.group_keys[i], values[i]) for i in order]
+
+        if numpy is not None:
+            values = values[order]
+        else:
+            values = array.array('d', [values[i] for i in order])
+
+        return TrackColumns(rows, values)
+
+    def select(self, min_value=None, max_value=None, reverse=False, limit=None):
+        '''
+        Returns the rows with values between min_value and max_value ordered by value,
+        at most limit of them. Ties keep the order the rows were loaded in.
+        '''
+
+        if numpy is not None:
+            mask = numpy.ones(len(self.values), dtype=bool)
+            if min_value is not None:
+                mask &= self.values >= min_value
+            if max_value is not None:
+                mask &= self.values <= max_value
+
+            positions = numpy.flatnonzero(mask)
+            keys = self.values[positions]
+            if reverse:
+                keys = -keys
+
+            if limit and limit < len(positions):
+                # Only the best limit need sorting. Ties with the last one are taken in
+                # load order, argpartition would pick between them arbitrarily
+                last = numpy.partition(keys, limit - 1)[limit - 1]
+                better = numpy.flatnonzero(keys < last)
+                ties = numpy.flatnonzero(keys == last)[:limit - len(better)]
+                best = numpy.sort(numpy.concatenate([better, ties]))
+                positions, keys = positions[best], keys[best]
+
+            positions = positions[numpy.argsort(keys, kind='mergesort')]
+            if limit:
+                positions = positions[:limit]
+        else:
+            values = self.values
+            positions = (i for i, value in enumerate(values)
+                         if (min_value is None or value >= min_value) and (max_value is None or value <= max_value))
+
+            if limit:
+                # Keeps a heap of the best limit seen so far rather than sorting everything
+                best = heapq.nlargest if reverse else heapq.nsmallest
+                positions = best(limit, positions, key=values.__getitem__)
+            else:
+                positions = sorted(positions, key=values.__getitem__, reverse=reverse)
+
+        return [self.rows[i] for i in positions]
+
+AGGREGATES = ['count', 'sum', 'mean', 'min', 'max']
+
+def group_stats(tracks, group_by, fields):
+    '''
+    Works out the count, sum, mean, min and max of several fields for every group of
+    tracks in a single pass, where tracks are grouped by the values of the group_by
+    fields. fields is a list of (field, to_number, default), tracks without a field
+    count as default or are left out of its figures if default is None.
+
+    Returns a row per group, in the order the groups were first seen, holding the
+    group_by fields, the number of tracks as 'count' and 'field.aggregate' for
+    each aggregate of each field that had any values.
+    '''
+
+    groups = {}
+    keys = []
+
+    for track in tracks:
+        key = tuple(track.get(key_field) for key_field in group_by)
+
+        stats = groups.get(key)
+        if stats is None:
+            # Track count, then [count, sum, min, max] of each field
+            stats = groups[key] = [0] + [[0, 0.0, None, None] for _ in fields]
+            keys.append(key)
+
+        stats[0] += 1
+
+        for field_stats, (field, to_number, default) in zip(stats[1:], fields):
+            value = track.get(field, default)
+            if value is None or value == '':
+                continue
+
+            value = to_number(value)
+            field_stats[0] += 1
+            field_stats[1] += value
+            if field_stats[2] is None or value < field_stats[2]:
+                field_stats[2] = value
+            if field_stats[3] is None or value > field_stats[3]:
+                field_stats[3] = value
+
+    rows = []
+    for key in keys:
+        stats = groups[key]
+        row = dict(zip(group_by, key))
+        row['count'] = stats[0]
+
+        for (count, total, low, high), (field, _, _) in zip(stats[1:], fields):
+            if count:
+                row[field + '.count'] = count
+                row[field + '.sum'] = total
+                row[field + '.mean'] = total / count
+                row[field + '.min'] = low
+                row[field + '.max'] = high
+
+        rows.append(row)
+
+    return rows
@@ -21,4 +21,56 @@ DOWN_VOTE_FOR_UNDECIDED = -30
 THRESHOLD_FOR_UP_VOTE = (120, .8) # (seconds, percentage)
 THRESHOLD_FOR_DOWN_VOTE = (10, .1)
 
+# Append changes to a .tracks.journal file instead of rewriting .tracks on every save
+TRACK_DB_JOURNAL = False
 
+# Seconds to wait for further changes before writing the track DB while playing
+TRACK_DB_SAVE_DELAY = 5
+
+# Storage used for newly created track DBs: 'json', 'binary' (compact JSON replacement),
+# 'sqlite' or 'packed' (memory-mapped and loaded lazily). Use 'main.py convert' to switch an existing one
+TRACK_DB_BACKEND = 'json'
+
+# Sync each track DB write to disk so a crash can't lose or corrupt it
+TRACK_DB_FSYNC = True
+
+# Number of rotating .tracks~ backups to keep, a new one is only taken when the DB changed
+TRACK_DB_BACKUPS = 3
+
+# Processes used to read tags during init, None for one per CPU
+SCAN_WORKERS = None
+
+# Keep the track DB in sync with the music directory while playing (uses pyinotify if installed)
+WATCH_LIBRARY = False
+
+# 'pools' splits tracks into accepted and undecided by ACCEPTED_THRESHOLD, 'weighted' picks
+# any track with a chance based on SHUFFLE_WEIGHT(track), or on rating, skips and how
+# recently it was played if that's None
+SHUFFLE_MODE = 'pools'
+SHUFFLE_WEIGHT = None
+
+# Keep the last few tracks played, and other tracks by the last few artists and albums
+# played, from being picked again. 0 turns each one off
+AVOID_REPEATING_TRACKS = 20
+AVOID_REPEATING_ARTISTS = 2
+AVOID_REPEATING_ALBUMS = 1
+
+# Number of tracks to pick ahead of the one playing, and whether to read their files in
+# the background so they start without a gap on slow disks or network mounts
+UPCOMING_TRACKS = 2
+PREFETCH_UPCOMING = True
+
+# Most results to list for the search command, None for all of them
+SEARCH_RESULT_LIMIT = 50
+
+# Let search words match misspelled ones sharing at least SEARCH_FUZZY_SIMILARITY of
+# their letter triples. Accents are always ignored
+SEARCH_FUZZY = True
+SEARCH_FUZZY_SIMILARITY = 0.4
+
+# Seconds between checks on the player when its wrapper tells us about changes itself
+EVENT_FALLBACK_TICK_INTERVAL = 15
+
+# 'threads' runs the player with a thread for input and one for ticks, 'event_loop' runs
+# it all on one thread with select() (not on Windows)
+PLAYER_RUNTIME = 'threads'
@@ -2,14 +2,30 @@ import datetime
 import os
 import json
 import argparse
+import multiprocessing
+import Queue
 import eyed3
 import kaa.metadata
 
-from smartplayer.utils import PersistedDict
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from smartplayer.utils import PersistedDict, backup_file, replace_file
+from smartplayer.utils.binary import is_binary_data
+from smartplayer.utils.packed import PackedDict, PACKED_HEADER, PACKED_HEADER_V1
+from smartplayer.utils.sqlite import SqliteDict, SQLITE_HEADER
 from smartplayer import settings
 
 SUPPORTED_FILE_TYPES = ['wma', 'm4a', 'mp3', 'mp4']
 
+# How often (in files) to report progress while loading tag information
+PROGRESS_INTERVAL = 500
+
 class ID3Exception(Exception):
     pass
 
@@ -17,16 +33,43 @@ class LoadException(Exception):
     pass
 
 def find_files(path, types=None):
+    '''
+    Yields the files under path with one of the given extensions as they are found.
+    '''
+
     if types is None:
         types = []
 
-    found = []
-    for root, _, files in os.walk(os.path.expanduser(path)):
-        for f in files:
-            if any(f.lower().endswith('.' + ext) for ext in types):
-                found.append(root + '/' + f)
+    extensions = set('.' + ext.lower() for ext in types)
+    directories = [os.path.expanduser(path)]
+
+    while directories:
+        root = directories.pop()
+
+        try:
+            entries = _list_directory(root)
+        except OSError:
+            # Same as os.walk, skip directories we can't read
+            continue
+
+        for name, is_directory in entries:
+            if is_directory:
+                directories.append(root + '/' + name)
+            elif os.path.splitext(name)[1].lower() in extensions:
+                yield root + '/' + name
 
-    return found
+def _list_directory(path):
+    # scandir (built in from Python 3.5, otherwise the scandir package) knows which
+    # entries are directories from the listing itself instead of a stat per entry
+    if scandir:
+        return [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in scandir(path)]
+
+    entries = []
+    for name in os.listdir(path):
+        full_path = os.path.join(path, name)
+        entries.append((name, os.path.isdir(full_path) and not os.path.islink(full_path)))
+
+    return entries
 
 def load_id3_information(file_path):
     for method in (_attempt_eyed3_load, _attempt_kaa_load):
@@ -39,6 +82,54 @@ def load_id3_information(file_path):
     else:
         raise ID3Exception("Failed to load information for %s" % file_path)
 
+def _load_id3_information_or_error(file_path):
+    # Runs in a worker process so exceptions are handed back rather than raised
+    try:
+        return file_path, load_id3_information(file_path), None
+    except Exception, e:
+        return file_path, None, str(e)
+
+def load_id3_information_for(file_paths, workers=None):
+    '''
+    Loads tag information for each of file_paths across a pool of worker processes
+    (one per CPU by default), yielding (file_path, id3_info, error) as each file is
+    finished, in no particular order. With a single worker everything is loaded in
+    this process.
+
+    file_paths can be a generator that is still finding files, each one is handed
+    to the pool as soon as it comes out and finished results are yielded in between,
+    all on the calling thread.
+    '''
+
+    if workers == 1:
+        for file_path in file_paths:
+            yield _load_id3_information_or_error(file_path)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    results = Queue.Queue()
+    pending = 0
+
+    try:
+        for file_path in file_paths:
+            pool.apply_async(_load_id3_information_or_error, (file_path,), callback=results.put)
+            pending += 1
+
+            while pending and not results.empty():
+                pending -= 1
+                yield results.get()
+
+        while pending:
+            pending -= 1
+            yield results.get()
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
 def _attempt_eyed3_load(file_path):
     try:
         id3_info = eyed3.load(file_path)
@@ -72,10 +163,72 @@ def get_track_info(path):
         print e
 
     if tracks_file:
-        db = PersistedDict(tracks_file)
-        for track_info in db.values():
+        db = open_track_db(tracks_file)
+        for track_info in db.itervalues():
             yield track_info
 
+TRACK_DB_BACKENDS = ['json', 'binary', 'sqlite', 'packed']
+
+def detect_backend(file_path):
+    '''
+    Works out which backend wrote the track DB at file_path from the start of the file.
+    '''
+
+    with open(file_path, 'rb') as f:
+        header = f.read(max(len(SQLITE_HEADER), len(PACKED_HEADER)))
+
+    if header.startswith(SQLITE_HEADER):
+        return 'sqlite'
+    elif header.startswith(PACKED_HEADER) or header.startswith(PACKED_HEADER_V1):
+        return 'packed'
+    elif is_binary_data(header):
+        return 'binary'
+
+    return 'json'
+
+def open_track_db(tracks_file, overwrite=False, save_delay=0, backend=None):
+    '''
+    Opens the track DB in whatever format tracks_file is already in. New (or
+    overwritten) files are created with the given backend, defaulting to
+    settings.TRACK_DB_BACKEND.
+    '''
+
+    if overwrite or not os.path.exists(tracks_file):
+        backend = backend or settings.TRACK_DB_BACKEND
+    else:
+        backend = detect_backend(tracks_file)
+
+    if backend == 'packed':
+        return PackedDict(tracks_file, overwrite=overwrite, save_delay=save_delay, fsync=settings.TRACK_DB_FSYNC, backups=settings.TRACK_DB_BACKUPS)
+    elif backend == 'sqlite':
+        return SqliteDict(tracks_file, overwrite=overwrite, save_delay=save_delay, date_format=settings.DATE_FORMAT, fsync=settings.TRACK_DB_FSYNC, backups=settings.TRACK_DB_BACKUPS)
+    elif backend in ('json', 'binary'):
+        return PersistedDict(tracks_file, overwrite=overwrite, journal=settings.TRACK_DB_JOURNAL, save_delay=save_delay, fsync=settings.TRACK_DB_FSYNC, backups=settings.TRACK_DB_BACKUPS, binary=(backend == 'binary'), date_format=settings.DATE_FORMAT)
+    else:
+        raise Exception("Unrecognized track DB backend '%s'" % backend)
+
+def convert_track_db(path, backend):
+    tracks_file = find_tracks_file(path)
+    source = open_track_db(tracks_file)
+    tracks = dict((key, dict(value)) for key, value in source.items())
+    source.close()
+
+    # Keep the original around in case something goes wrong
+    backup_file(tracks_file, max(settings.TRACK_DB_BACKUPS, 1))
+
+    converted_file = tracks_file + '.converting'
+    converted = open_track_db(converted_file, overwrite=True, backend=backend)
+    for key, value in tracks.iteritems():
+        converted[key] = value
+    converted.close()
+
+    replace_file(converted_file, tracks_file)
+
+    # A journal left behind by the old file would otherwise be replayed on top of the new one
+    for journal_path in (tracks_file + '.journal', tracks_file + '.journal.compacting'):
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+
 def find_tracks_file(path):
     path = os.path.abspath(os.path.expanduser(path))
 
@@ -102,40 +255,128 @@ def display_track(json_data):
     else:
         return "%s" % json_data['file_path']
 
-def update_from_path(path, overwrite=False, verbose=False, types=None):
-    db = PersistedDict(os.path.join(path, '.tracks'), overwrite=overwrite)
+def create_track_info(file_path, id3_info, date_added, fingerprint):
+    track_info = {
+        'file_path': file_path,
+        'pk': file_path,
+        'date_added': date_added,
+        'fingerprint': fingerprint,
+    }
+    track_info.update(id3_info)
+
+    return track_info
+
+def get_track_path_converter(db, root_path):
+    '''
+    Returns a function turning an absolute file path into the form the DB keys its
+    tracks by. Keys are the paths found by the init that created the DB, so they are
+    either absolute or relative to root_path starting with './' (the default
+    directory).
+    '''
+
+    sample = next(iter(db), None)
+    if sample is None or os.path.isabs(sample):
+        return lambda file_path: json.loads(json.dumps(file_path))
+
+    prefix = './' if sample.startswith('./') else ''
+    return lambda file_path: json.loads(json.dumps(prefix + os.path.relpath(file_path, root_path)))
+
+def get_fingerprint(file_path):
+    '''
+    What we know about a file without reading it, if this hasn't changed since the
+    last scan there's no need to read its tags again.
+    '''
+
+    stat = os.stat(file_path)
+    return [stat.st_mtime, stat.st_size, stat.st_ino]
+
+def update_from_path(path, overwrite=False, verbose=False, types=None, workers=None):
+    db = open_track_db(os.path.join(path, '.tracks'), overwrite=overwrite)
     not_seen = set(db.keys())
     track_info_added = {}
     failures = []
+    fingerprints = {}
 
     date_added = datetime.datetime.now().strftime(settings.DATE_FORMAT)
-    for file_path in find_files(path, types=types):
+
+    # A file that moved keeps its inode, so it can be picked up without reading its tags
+    known_fingerprints = {}
+    for file_path in not_seen:
+        fingerprint = db[file_path].get('fingerprint')
+        if fingerprint and fingerprint[2]:
+            known_fingerprints[tuple(fingerprint)] = file_path
+
+    def files_to_load():
+        # Scans for files as the tags of the ones found so far are being loaded
+        possibly_moved = []
+
+        for file_path in find_files(path, types=types):
+            escaped_file_path = json.loads(json.dumps(file_path))
+            fingerprint = fingerprints[escaped_file_path] = get_fingerprint(file_path)
+
+            if escaped_file_path in db:
+                not_seen.discard(escaped_file_path)
+                track_info = db[escaped_file_path]
+
+                # Tracks from before fingerprints were kept are assumed to be up to date
+                if 'fingerprint' not in track_info:
+                    track_info['fingerprint'] = fingerprint
+                elif track_info['fingerprint'] != fingerprint:
+                    yield file_path
+            elif tuple(fingerprint) in known_fingerprints:
+                # Can't tell if it moved until we know the old file is gone
+                possibly_moved.append(file_path)
+            else:
+                yield file_path
+
+        for file_path in possibly_moved:
+            escaped_file_path = json.loads(json.dumps(file_path))
+            old_name = known_fingerprints.pop(tuple(fingerprints[escaped_file_path]), None)
+
+            if old_name in not_seen:
+                if verbose:
+                    print "Moved '%s' to '%s'" % (old_name, escaped_file_path)
+
+                db[escaped_file_path] = dict(db[old_name], file_path=escaped_file_path, pk=escaped_file_path)
+                del db[old_name]
+                not_seen.remove(old_name)
+            else:
+                yield file_path
+
+    loaded = 0
+    for file_path, id3_info, error in load_id3_information_for(files_to_load(), workers=workers):
         escaped_file_path = json.loads(json.dumps(file_path))
 
+        loaded += 1
+        if loaded % PROGRESS_INTERVAL == 0:
+            print "Loaded %d changed or new files so far" % loaded
+
+        if error:
+            failures.append(ID3Exception(error))
+            continue
+
         if escaped_file_path in db:
-            not_seen.remove(escaped_file_path)
-        else:
             if verbose:
-                print "Attempting to add new file: '%s':" % escaped_file_path
+                print "Updating changed file: '%s':" % escaped_file_path
+
+            db[escaped_file_path].update(id3_info, fingerprint=fingerprints[escaped_file_path])
+            continue
 
-            id3_info = load_id3_information(file_path)
+        if verbose:
+            print "Adding new file: '%s':" % escaped_file_path
 
-            track_info = {
-                'file_path': escaped_file_path,
-                'pk': escaped_file_path,
-                'date_added': date_added,
-            }
-            track_info.update(id3_info)
+        track_info = create_track_info(escaped_file_path, id3_info, date_added, fingerprints[escaped_file_path])
+        db[escaped_file_path] = track_info
+        track_key = get_track_key(track_info)
 
-            db[escaped_file_path] = track_info
-            track_key = get_track_key(track_info)
+        if track_key:
+            if track_key in track_info_added:
+                failures.append(LoadException("Added multiple files with the same ID3 information: '%s' and '%s'" % (escaped_file_path, track_info_added[track_key]['file_path'])))
 
-            if track_key:
-                if track_key in track_info_added:
-                    failures.append(LoadException("Added multiple files with the same ID3 information: '%s' and '%s'" % (escaped_file_path, track_info_added[track_key]['file_path'])))
 
+            track_info_added[get_track_key(track_info)] = track_info
 
-                track_info_added[get_track_key(track_info)] = track_info
+    print "Loaded %d changed or new files" % loaded
 
     claimed_renames = {}
     # Remove missing entries
@@ -158,7 +399,7 @@ def update_from_path(path, overwrite=False, verbose=False, types=None):
 
         del db[file_path]
 
-    db.save()
+    db.close()
 
     for fail in failures:
         print fail
@@ -0,0 +1,213 @@
+import json
+import os
+
+from smartplayer.utils import atomic_write
+
+GROUP_FIELDS = ['artist', 'album']
+
+# The DB files whose state a stamp records, the journal and WAL hold changes too
+DB_SUFFIXES = ['', '.journal', '.journal.compacting', '-wal']
+
+# Where each field's total is in a group's figures and how it's totalled
+TRACKS, LISTEN_COUNT, SKIP_COUNT, RATING, DATE_PLAYED = range(5)
+FIGURES = {
+    'listen_count': (LISTEN_COUNT, 'sum'),
+    'skip_count': (SKIP_COUNT, 'sum'),
+    'rating': (RATING, 'sum'),
+    'date_played': (DATE_PLAYED, 'max'),
+}
+
+def aggregates_path(db_path):
+    return db_path + '.aggregates'
+
+def db_stamp(file_path):
+    '''
+    Something that changes whenever the DB at file_path is written to.
+    '''
+
+    stamp = []
+    for suffix in DB_SUFFIXES:
+        try:
+            stat = os.stat(file_path + suffix)
+        except OSError:
+            continue
+        stamp.append([suffix, stat.st_ino, stat.st_size, stat.st_mtime])
+
+    return stamp
+
+class TrackAggregates(object):
+    '''
+    Totals for each artist and each album: how many tracks they have, the sum of
+    their listen_count, skip_count and rating (the mean rating is rating / tracks)
+    and the latest date_played.
+
+    They're saved next to the track DB with a stamp of the DB's files, so a report
+    on them can skip reading the tracks for as long as nothing else has written to
+    the DB. The player keeps them up to date by calling add() whenever a track
+    changes and remove() when one goes, which only touches the groups the track is
+    in.
+
+    Loaded aggregates don't know what each track added, so they can't take a track
+    back out. Given source, a function returning every track, add() and remove()
+    work the totals out again from it the first time they're called. Aggregates
+    made with only a source aren't worked out until something needs them.
+
+    date_key turns a date_played into something that orders correctly.
+    '''
+
+    def __init__(self, date_key, tracks=(), source=None):
+        self.date_key = date_key
+        self.groups = dict((field, {}) for field in GROUP_FIELDS)
+        self.stamp = None
+        self.source = source
+        self.changed = False
+
+        # What each track added to which groups, so it can be taken back out
+        self.contributions = {}
+        self.members = dict((field, {}) for field in GROUP_FIELDS)
+
+        for track in tracks:
+            self.add(track)
+
+    @classmethod
+    def load(cls, file_path, db_path, date_key, source=None):
+        '''
+        Returns the aggregates saved at file_path if the DB at db_path hasn't been
+        written to since, otherwise None.
+        '''
+
+        try:
+            with open(file_path, 'rb') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if data.get('stamp') != db_stamp(db_path):
+            return None
+
+        aggregates = cls(date_key, source=source)
+        aggregates.stamp = data['stamp']
+        for field in GROUP_FIELDS:
+            aggregates.groups[field] = dict((key, figures) for key, figures in data['groups'].get(field, []))
+
+        return aggregates
+
+    def save(self, file_path, db_path, stamp=None):
+        '''
+        Saves the aggregates as matching the DB at db_path as it is now, or as it
+        was when stamp was taken.
+        '''
+
+        if self.stamp is None:
+            self.build()
+
+        self.stamp = stamp if stamp is not None else db_stamp(db_path)
+        self.changed = False
+
+        # Keys can be None so each group is stored as a [key, figures] pair
+        groups = dict((field, self.groups[field].items()) for field in GROUP_FIELDS)
+
+        with atomic_write(file_path, fsync=False) as f:
+            f.write(json.dumps({'stamp': self.stamp, 'groups': groups}))
+
+    def build(self):
+        '''
+        Works the totals out from every track in source(), if that hasn't been done.
+        '''
+
+        if self.source is None:
+            return
+
+        tracks = self.source()
+        self.source = None
+
+        self.groups = dict((field, {}) for field in GROUP_FIELDS)
+        self.contributions = {}
+        self.members = dict((field, {}) for field in GROUP_FIELDS)
+        for track in tracks:
+            self.add(track)
+
+    def figures(self, track):
+        return [1, track.get('listen_count', 0), track.get('skip_count', 0), track.get('rating', 0), track.get('date_played') or None]
+
+    def later(self, date, other):
+        if date is None:
+            return other
+        if other is None:
+            return date
+
+        return date if self.date_key(date) >= self.date_key(other) else other
+
+    def add(self, track):
+        self.build()
+        self.changed = True
+
+        pk = track['pk']
+        if pk in self.contributions:
+            self.remove(pk)
+
+        figures = self.figures(track)
+        keys = [track.get(field) for field in GROUP_FIELDS]
+        self.contributions[pk] = (keys, figures)
+
+        for field, key in zip(GROUP_FIELDS, keys):
+            self.members[field].setdefault(key, set()).add(pk)
+
+            group = self.groups[field].get(key)
+            if group is None:
+                group = self.groups[field][key] = [0, 0, 0, 0, None]
+
+            for i in (TRACKS, LISTEN_COUNT, SKIP_COUNT, RATING):
+                group[i] += figures[i]
+            group[DATE_PLAYED] = self.later(group[DATE_PLAYED], figures[DATE_PLAYED])
+
+    def remove(self, pk):
+        self.build()
+
+        if pk not in self.contributions:
+            return
+
+        keys, figures = self.contributions.pop(pk)
+        self.changed = True
+
+        for field, key in zip(GROUP_FIELDS, keys):
+            members = self.members[field][key]
+            members.discard(pk)
+
+            if not members:
+                del self.members[field][key]
+                del self.groups[field][key]
+                continue
+
+            group = self.groups[field][key]
+            for i in (TRACKS, LISTEN_COUNT, SKIP_COUNT, RATING):
+                group[i] -= figures[i]
+
+            # Only a group losing its latest play has to look through its other tracks
+            if figures[DATE_PLAYED] is not None and figures[DATE_PLAYED] == group[DATE_PLAYED]:
+                group[DATE_PLAYED] = reduce(self.later, (self.contributions[member][1][DATE_PLAYED] for member in members), None)
+
+    def rows(self, group_field, field):
+        '''
+        Returns a row per group of group_field holding the group's total for field,
+        shaped like the rows report_by makes by reading every track and in the same
+        key order, so ties come out the same either way. Rows also hold the number
+        of tracks as 'count' and, for summed fields, the mean as 'field.mean', named
+        like the rows of group_stats.
+        '''
+
+        if self.stamp is None:
+            self.build()
+
+        index, aggregate = FIGURES[field]
+        rows = []
+
+        for key, figures in sorted(self.groups[group_field].iteritems()):
+            row = {group_field: key, 'count': figures[TRACKS]}
+            if figures[index] is not None:
+                row[field] = figures[index]
+            if aggregate == 'sum':
+                row[field + '.mean'] = figures[index] / float(figures[TRACKS])
+            rows.append(row)
+
+        return rows
@@ -0,0 +1,283 @@
+import gc
+import hashlib
+import json
+import marshal
+import re
+import unicodedata
+from bisect import bisect_left, insort
+
+from smartplayer.utils import atomic_write
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+SEARCH_INDEX_HEADER = 'SPSEARCH\x02'
+
+def normalize(text):
+    '''
+    Lower cases text and strips accents so accented and unaccented spellings compare equal.
+    '''
+
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+
+    decomposed = unicodedata.normalize('NFKD', text)
+    return u''.join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+def tokenize(text):
+    return WORD_RE.findall(normalize(text)) if text else []
+
+def trigrams(word):
+    padded = u'  %s ' % word
+    return set(padded[i:i + 3] for i in xrange(len(padded) - 2))
+
+class SearchIndex(object):
+    '''
+    An inverted index from the words in each track's SEARCH_FIELDS to the pks of the
+    tracks containing them. Words are also kept sorted so every word starting with a
+    prefix can be found with a binary search, letting "beat" find "Beatles".
+
+    With fuzzy on, each word is also indexed by its trigrams so misspelled words
+    can find words that share enough of them. Only the distinct words are indexed
+    this way rather than every track, which keeps it small.
+
+    Tracks are added and removed one at a time as the library changes, so the index
+    never has to be rebuilt while playing. save() and load() keep it in a file so it
+    doesn't have to be built from scratch each time either.
+    '''
+
+    SEARCH_FIELDS = ['title', 'artist', 'album']
+
+    # How much a match in each field counts towards a track's rank
+    FIELD_WEIGHTS = {'title': 3, 'artist': 2, 'album': 1}
+
+    # Similarity of a word that the search text is the start of, whole words are 1.0
+    PREFIX_SIMILARITY = 0.8
+
+    def __init__(self, tracks=(), fuzzy=False, min_similarity=0.4):
+        self.fuzzy = fuzzy
+        self.min_similarity = min_similarity
+        self.postings = {}
+        self.words = []
+        self.trigrams = {}
+        self.tracks = {}
+        self.track_words = {}
+        self.sources = {}
+        self.changed = False
+
+        for track in tracks:
+            self.add(track)
+
+    def __len__(self):
+        return len(self.track_words)
+
+    @classmethod
+    def load(cls, file_path, tracks, fuzzy=False, min_similarity=0.4):
+        '''
+        Loads the index saved at file_path and brings it up to date with tracks, only
+        re-indexing the ones whose fields changed. Builds it from scratch if the file
+        is missing or unreadable.
+        '''
+
+        index = cls(fuzzy=fuzzy, min_similarity=min_similarity)
+
+        # Loading makes a lot of containers and no cycles, the garbage collector only slows it down
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            loaded = index.read_from_file(file_path)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        seen = set()
+
+        for track in tracks:
+            pk = track['pk']
+            seen.add(pk)
+
+            if loaded and index.sources.get(pk) == index.source(track):
+                index.tracks[pk] = track
+            else:
+                index.add(track)
+
+        for pk in [key for key in index.track_words if key not in seen]:
+            index.remove(pk)
+
+        return index
+
+    def read_from_file(self, file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+
+            if not data.startswith(SEARCH_INDEX_HEADER):
+                return False
+
+            words, entries = marshal.loads(data[len(SEARCH_INDEX_HEADER):])
+        except (IOError, OSError, ValueError, EOFError, TypeError):
+            return False
+
+        postings = [[] for _ in words]
+        title, artist, album = self.SEARCH_FIELDS
+
+        for pk, source, (title_numbers, artist_numbers, album_numbers) in entries:
+            self.sources[pk] = source
+            self.track_words[pk] = {
+                title: set([words[i] for i in title_numbers]),
+                artist: set([words[i] for i in artist_numbers]),
+                album: set([words[i] for i in album_numbers]),
+            }
+
+            for i in set(title_numbers + artist_numbers + album_numbers):
+                postings[i].append(pk)
+
+        self.postings = dict((word, set(pks)) for word, pks in zip(words, postings) if pks)
+        self.words = sorted(self.postings)
+
+        if self.fuzzy:
+            for word in self.words:
+                for trigram in trigrams(word):
+                    self.trigrams.setdefault(trigram, set()).add(word)
+
+        return True
+
+    def save(self, file_path):
+        # Words are stored once and referred to by number, which loads much faster than sets of strings
+        numbers = dict((word, i) for i, word in enumerate(self.words))
+        entries = [(pk, self.sources[pk], [[numbers[word] for word in self.track_words[pk][field]] for field in self.SEARCH_FIELDS])
+                   for pk in self.track_words]
+
+        with atomic_write(file_path, fsync=False) as f:
+            f.write(SEARCH_INDEX_HEADER)
+            f.write(marshal.dumps((self.words, entries)))
+
+        self.changed = False
+
+    def source(self, track):
+        # Enough to tell whether a track needs indexing again without keeping copies of its fields.
+        # It's saved with the index, so it has to come out the same in every process.
+        return hashlib.md5(json.dumps([track.get(field) for field in self.SEARCH_FIELDS])).digest()
+
+    def add(self, track):
+        pk = track['pk']
+        if pk in self.track_words:
+            self.remove(pk)
+
+        fields = dict((field, set(tokenize(track.get(field)))) for field in self.SEARCH_FIELDS)
+        self.tracks[pk] = track
+        self.track_words[pk] = fields
+        self.sources[pk] = self.source(track)
+        self.changed = True
+
+        for word in set().union(*fields.values()):
+            if word not in self.postings:
+                self.postings[word] = set()
+                insort(self.words, word)
+
+                if self.fuzzy:
+                    for trigram in trigrams(word):
+                        self.trigrams.setdefault(trigram, set()).add(word)
+
+            self.postings[word].add(pk)
+
+    def remove(self, pk):
+        if pk not in self.track_words:
+            return
+
+        self.tracks.pop(pk, None)
+        self.sources.pop(pk, None)
+        fields = self.track_words.pop(pk)
+        self.changed = True
+
+        for word in set().union(*fields.values()):
+            pks = self.postings[word]
+            pks.discard(pk)
+
+            if not pks:
+                del self.postings[word]
+                del self.words[bisect_left(self.words, word)]
+
+                if self.fuzzy:
+                    for trigram in trigrams(word):
+                        words = self.trigrams[trigram]
+                        words.discard(word)
+                        if not words:
+                            del self.trigrams[trigram]
+
+    def words_starting_with(self, prefix):
+        i = bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            yield self.words[i]
+            i += 1
+
+    def similar_words(self, token):
+        # Similarity is the share of their trigrams two words have in common (the Dice coefficient)
+        token_trigrams = trigrams(token)
+        shared = {}
+
+        for trigram in token_trigrams:
+            for word in self.trigrams.get(trigram, ()):
+                shared[word] = shared.get(word, 0) + 1
+
+        similar = {}
+        for word, count in shared.iteritems():
+            similarity = 2.0 * count / (len(token_trigrams) + len(trigrams(word)))
+            if similarity >= self.min_similarity:
+                similar[word] = similarity * self.PREFIX_SIMILARITY
+
+        return similar
+
+    def matching_words(self, token):
+        '''
+        Returns {word: similarity} for every indexed word token could be referring to.
+        '''
+
+        words = self.similar_words(token) if self.fuzzy else {}
+
+        for word in self.words_starting_with(token):
+            words[word] = self.PREFIX_SIMILARITY
+        if token in self.postings:
+            words[token] = 1.0
+
+        return words
+
+    def score(self, pk, token_words):
+        score = 0.0
+        for words in token_words:
+            score += max(self.FIELD_WEIGHTS[field] * max([words.get(word, 0.0) for word in field_words] or [0.0])
+                         for field, field_words in self.track_words[pk].iteritems())
+
+        return score
+
+    def search(self, text, limit=None):
+        '''
+        Returns the tracks matching each word in text, most similar first and then by
+        rating. Whole words beat prefixes, prefixes beat fuzzy matches, and matches in
+        the title beat the artist or album.
+        '''
+
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+
+        token_words = [self.matching_words(token) for token in tokens]
+        token_pks = []
+
+        for words in token_words:
+            pks = set()
+            for word in words:
+                pks.update(self.postings[word])
+            token_pks.append(pks)
+
+        # Start from the rarest token so the intersections stay small
+        candidates = None
+        for pks in sorted(token_pks, key=len):
+            candidates = pks if candidates is None else candidates & pks
+            if not candidates:
+                return []
+
+        ranked = sorted(candidates, key=lambda pk: (-self.score(pk, token_words), -self.tracks[pk].get('rating', 0)))
+        if limit:
+            ranked = ranked[:limit]
+
+        return [self.tracks[pk] for pk in ranked]
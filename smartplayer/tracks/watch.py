@@ -0,0 +1,217 @@
+import os
+from threading import Thread, Timer, Event
+
+from . import find_files, _list_directory
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+ADDED = 'added'
+REMOVED = 'removed'
+MOVED = 'moved'
+
+def watch_library(path, types, callback, poll_interval=5.0):
+    '''
+    Starts watching path for files with the given extensions being added, removed or
+    moved, calling callback(event, file_path, old_file_path) from a background thread
+    for each one. A REMOVED file_path can be a directory, meaning everything under it
+    is gone. Uses inotify when pyinotify is installed and polls otherwise.
+
+    Returns the watcher, call stop() on it when done.
+    '''
+
+    if pyinotify:
+        watcher = InotifyWatcher(path, types, callback)
+    else:
+        watcher = PollingWatcher(path, types, callback, interval=poll_interval)
+
+    watcher.start()
+    return watcher
+
+class PollingWatcher(Thread):
+    '''
+    Checks the modification time of every directory each interval and only lists the
+    ones that changed, so a poll costs a stat per directory rather than a rescan of
+    every file. This sees files being added, removed and moved but not edited.
+    '''
+
+    def __init__(self, path, types, callback, interval=5.0):
+        super(PollingWatcher, self).__init__()
+        self.daemon = True
+        self.path = os.path.expanduser(path)
+        self.extensions = set('.' + ext.lower() for ext in types)
+        self.callback = callback
+        self.interval = interval
+        self.stopped = Event()
+        self.directories = {}
+        self.files = {}
+
+        self.add_directory(self.path)
+
+    def add_directory(self, path, added=None):
+        '''
+        Starts keeping track of path and everything under it. Files found are put in
+        added, if given, so they can be reported along with the rest of a poll.
+        '''
+
+        try:
+            mtime = os.stat(path).st_mtime
+            entries = _list_directory(path)
+        except OSError:
+            return
+
+        self.directories[path] = mtime
+        self.files[path] = {}
+
+        for name, is_directory in entries:
+            full_path = path + '/' + name
+
+            if is_directory:
+                self.add_directory(full_path, added)
+            elif os.path.splitext(name)[1].lower() in self.extensions:
+                self.files[path][name] = self.inode(full_path)
+                if added is not None:
+                    added[full_path] = self.files[path][name]
+
+    def inode(self, file_path):
+        try:
+            return os.stat(file_path).st_ino
+        except OSError:
+            return None
+
+    def poll(self):
+        added = {}
+        removed = {}
+
+        for path in self.directories.keys():
+            if path not in self.directories:
+                continue
+
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+
+            if mtime is None:
+                for name, inode in self.files.pop(path).iteritems():
+                    removed[path + '/' + name] = inode
+                del self.directories[path]
+                continue
+
+            if mtime == self.directories[path]:
+                continue
+
+            self.directories[path] = mtime
+            try:
+                entries = _list_directory(path)
+            except OSError:
+                continue
+
+            known = self.files[path]
+            listed = set()
+
+            for name, is_directory in entries:
+                full_path = path + '/' + name
+                listed.add(name)
+
+                if is_directory:
+                    if full_path not in self.directories:
+                        # Its files may have moved here from somewhere else, so they're matched up below
+                        self.add_directory(full_path, added)
+                elif name not in known and os.path.splitext(name)[1].lower() in self.extensions:
+                    known[name] = added[full_path] = self.inode(full_path)
+
+            for name in set(known) - listed:
+                removed[path + '/' + name] = known.pop(name)
+
+        # Something that disappeared and showed up somewhere else with the same inode moved
+        moved_from = dict((inode, file_path) for file_path, inode in removed.iteritems() if inode)
+
+        for file_path, inode in added.iteritems():
+            if inode in moved_from:
+                old_file_path = moved_from.pop(inode)
+                del removed[old_file_path]
+                self.callback(MOVED, file_path, old_file_path)
+            else:
+                self.callback(ADDED, file_path, None)
+
+        for file_path in removed:
+            self.callback(REMOVED, file_path, None)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class InotifyWatcher(object):
+    '''
+    Gets told about changes by the kernel. Files count as added once they have been
+    closed after writing, so edits to an existing file are reported as ADDED again.
+    '''
+
+    # How long to wait for the other half of a rename before treating it as a removal
+    MOVE_TIMEOUT = 1.0
+
+    def __init__(self, path, types, callback):
+        self.path = os.path.expanduser(path)
+        self.extensions = set('.' + ext.lower() for ext in types)
+        self.callback = callback
+        self.moves = {}
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(self.watch_manager, self.process_event)
+        self.notifier.daemon = True
+
+    def start(self):
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+        self.watch_manager.add_watch(self.path, mask, rec=True, auto_add=True)
+        self.notifier.start()
+
+    def stop(self):
+        self.notifier.stop()
+
+        for timer, _ in self.moves.values():
+            timer.cancel()
+
+    def wanted(self, event):
+        return event.dir or os.path.splitext(event.name)[1].lower() in self.extensions
+
+    def process_event(self, event):
+        if not self.wanted(event):
+            return
+
+        if event.mask & pyinotify.IN_CLOSE_WRITE:
+            self.callback(ADDED, event.pathname, None)
+        elif event.mask & pyinotify.IN_DELETE:
+            if not event.dir:
+                self.callback(REMOVED, event.pathname, None)
+        elif event.mask & pyinotify.IN_MOVED_FROM:
+            timer = Timer(self.MOVE_TIMEOUT, self.moved_away, (event.cookie,))
+            self.moves[event.cookie] = (timer, event.pathname)
+            timer.start()
+        elif event.mask & pyinotify.IN_MOVED_TO:
+            timer, old_path = self.moves.pop(event.cookie, (None, None))
+
+            if timer:
+                timer.cancel()
+
+            if event.dir:
+                for file_path in find_files(event.pathname, types=[ext[1:] for ext in self.extensions]):
+                    if old_path:
+                        self.callback(MOVED, file_path, old_path + file_path[len(event.pathname):])
+                    else:
+                        self.callback(ADDED, file_path, None)
+            elif old_path:
+                self.callback(MOVED, event.pathname, old_path)
+            else:
+                self.callback(ADDED, event.pathname, None)
+
+    def moved_away(self, cookie):
+        # Moved somewhere outside what we're watching
+        _, old_path = self.moves.pop(cookie, (None, None))
+        if old_path:
+            self.callback(REMOVED, old_path, None)
@@ -1,29 +1,471 @@
+import heapq
 import random
 import json
 import os
-from threading import Timer, Event, Thread
+import shutil
+import time
+from contextlib import contextmanager
+from itertools import count
+from Queue import PriorityQueue
+from threading import Timer, Thread, Condition, Lock, RLock
 
-class PersistedDict(dict):
-    def __init__(self, file_path, overwrite=False):
+from . import binary
+
+def replace_file(source, destination):
+    # os.rename won't replace an existing file on Windows
+    if os.name == 'nt' and os.path.exists(destination):
+        os.remove(destination)
+
+    os.rename(source, destination)
+
+def fsync_directory(path):
+    # Makes a rename in the directory durable, only possible on POSIX
+    if os.name == 'posix':
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+@contextmanager
+def atomic_write(file_path, fsync=True):
+    '''
+    Opens a temporary file to write to that replaces file_path once the block
+    finishes, so a crash part way through never leaves a half written file_path.
+    '''
+
+    temp_path = file_path + '.tmp'
+
+    try:
+        with open(temp_path, 'wb') as f:
+            yield f
+
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    replace_file(temp_path, file_path)
+
+    if fsync:
+        fsync_directory(os.path.dirname(file_path))
+
+def rotate_backups(file_path, count):
+    '''
+    Moves file_path~ (the newest backup) to file_path~2 and so on, dropping the
+    oldest of count, and returns the path the next backup should go to.
+    '''
+
+    backup_path = file_path + '~'
+
+    backup_paths = [backup_path] + ['%s~%d' % (file_path, i) for i in range(2, count + 1)]
+    for older, newer in reversed(zip(backup_paths[1:], backup_paths[:-1])):
+        if os.path.exists(newer):
+            replace_file(newer, older)
+
+    if os.path.exists(backup_path):
+        os.remove(backup_path)
+
+    return backup_path
+
+def backup_file(file_path, count):
+    '''
+    Keeps up to count backups of file_path as file_path~ (newest), file_path~2, etc.
+    A new backup is only taken if file_path changed since the last one.
+
+    The backup is a hard link where possible, which costs nothing to make but is
+    only safe for files that are always replaced (see atomic_write) rather than
+    written in place.
+    '''
+
+    backup_path = file_path + '~'
+
+    if not count or not os.path.exists(file_path):
+        return
+
+    if os.path.exists(backup_path):
+        current, backup = os.stat(file_path), os.stat(backup_path)
+        if (current.st_ino and current.st_ino == backup.st_ino) or (current.st_size, current.st_mtime) == (backup.st_size, backup.st_mtime):
+            return
+
+    backup_path = rotate_backups(file_path, count)
+
+    if hasattr(os, 'link'):
+        try:
+            os.link(file_path, backup_path)
+            return
+        except OSError:
+            pass
+
+    shutil.copy2(file_path, backup_path)
+
+class TrackedDict(dict):
+    '''
+    A dict handed out by a PersistedDict (or SqliteDict) that reports changes made
+    to it back to its owner, so in place edits like db[key]['rating'] += 1 get saved. Changes
+    made inside nested values (e.g. appending to a list) are not seen.
+    '''
+
+    def __init__(self, owner, key, *args, **kwargs):
+        super(TrackedDict, self).__init__(*args, **kwargs)
+        self.owner = owner
+        self.key = key
+
+    def changed(self):
+        self.owner.changed_keys.add(self.key)
+
+    def __setitem__(self, key, value):
+        with self.owner.lock:
+            super(TrackedDict, self).__setitem__(key, value)
+            self.changed()
+
+    def __delitem__(self, key):
+        with self.owner.lock:
+            super(TrackedDict, self).__delitem__(key)
+            self.changed()
+
+    def update(self, *args, **kwargs):
+        with self.owner.lock:
+            super(TrackedDict, self).update(*args, **kwargs)
+            self.changed()
+
+    def setdefault(self, key, default=None):
+        with self.owner.lock:
+            if key not in self:
+                self.changed()
+            return super(TrackedDict, self).setdefault(key, default)
+
+    def pop(self, key, *args):
+        with self.owner.lock:
+            self.changed()
+            return super(TrackedDict, self).pop(key, *args)
+
+class DelayedSaveMixin(object):
+    '''
+    Gives a DB a save() that waits for save_delay seconds without further saves
+    before calling flush(), so a burst of changes is written once.
+    '''
+
+    def save(self, *keys):
+        with self.lock:
+            self.changed_keys.update(keys)
+            self.cancel_delayed_save()
+
+            if self.save_delay:
+                self.save_timer = Timer(self.save_delay, self.flush)
+                self.save_timer.start()
+                return
+
+        self.flush()
+
+    def cancel_delayed_save(self):
+        # A write happening now covers whatever the timer was waiting to write
+        if self.save_timer:
+            self.save_timer.cancel()
+            self.save_timer = None
+
+class PersistedDict(DelayedSaveMixin, dict):
+    '''
+    A dict that is stored as JSON in file_path.
+
+    Dict values are stored as TrackedDicts so the keys that changed are known
+    without being told. save() only marks the DB as needing a write, the write
+    itself happens once no further saves arrive for save_delay seconds (or right
+    away if save_delay is 0) or when flush() or close() are called.
+
+    By default a write replaces the whole file. In journal mode a write instead
+    appends a record for each changed entry to file_path.journal, and once the
+    journal gets long enough it is folded back into the main file on a background
+    thread. Each write is synced to disk once if fsync is set.
+
+    With binary set the main file is written in the compact format from
+    smartplayer.utils.binary instead of JSON. Either format is read regardless,
+    date_format is only needed for binary files from before dates were kept as
+    text.
+    '''
+
+    JOURNAL_COMPACT_SIZE = 1000
+
+    def __init__(self, file_path, overwrite=False, journal=False, save_delay=0, fsync=True, backups=1, binary=False, date_format=None):
         super(PersistedDict, self).__init__()
         self.file_path = os.path.abspath(os.path.expanduser(file_path))
+        self.journal = journal
+        self.journal_path = self.file_path + '.journal'
+        self.compacting_path = self.journal_path + '.compacting'
+        self.journal_size = 0
+        self.changed_keys = set()
+        self.needs_snapshot = overwrite or not os.path.exists(self.file_path)
+        self.compactor = None
+        self.save_delay = save_delay
+        self.save_timer = None
+        self.lock = RLock()
+        self.fsync = fsync
+        self.backups = backups
+        self.binary = binary
+        self.date_format = date_format
         self.read_from_file(overwrite=overwrite)
 
     def read_from_file(self, overwrite):
+        if overwrite:
+            for path in (self.journal_path, self.compacting_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
         if os.path.exists(self.file_path):
             if not overwrite:
-                with open(self.file_path, 'r') as f:
-                    data = f.read()
-                    if data:
-                        self.update(json.loads(data))
+                with open(self.file_path, 'rb') as f:
+                    data = self.decode(f.read())
+
+                replay_journal(self.compacting_path, data)
+                self.journal_size, valid_size = replay_journal(self.journal_path, data)
+
+                # Drop any half written record so new ones aren't appended onto it
+                if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > valid_size:
+                    with open(self.journal_path, 'r+b') as f:
+                        f.truncate(valid_size)
+
+                for key, value in data.iteritems():
+                    dict.__setitem__(self, key, self.track(key, value))
+
+            # Keep a backup in case something goes wrong
+            backup_file(self.file_path, self.backups)
+
+    def track(self, key, value):
+        if isinstance(value, dict) and not (isinstance(value, TrackedDict) and value.owner is self and value.key == key):
+            value = TrackedDict(self, key, value)
+
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super(PersistedDict, self).__setitem__(key, self.track(key, value))
+            self.changed_keys.add(key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            super(PersistedDict, self).__delitem__(key)
+            self.changed_keys.add(key)
+
+    def flush(self):
+        with self.lock:
+            self.cancel_delayed_save()
+
+            if not (self.changed_keys or self.needs_snapshot):
+                return
+
+            if not self.journal or self.needs_snapshot or not os.path.exists(self.file_path):
+                # A compaction finishing afterwards would write older data over the snapshot
+                if self.compactor:
+                    self.compactor.join()
+
+                with atomic_write(self.file_path, fsync=self.fsync) as f:
+                    f.write(self.encode(self))
+                self.needs_snapshot = False
+
+                # The snapshot has everything, replaying old journals over it would undo newer changes
+                for path in (self.journal_path, self.compacting_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.journal_size = 0
+            else:
+                with open(self.journal_path, 'ab') as f:
+                    for key in self.changed_keys:
+                        if key in self:
+                            f.write(json.dumps([key, self[key]]) + '\n')
+                        else:
+                            f.write(json.dumps([key]) + '\n')
+
+                    if self.fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                self.journal_size += len(self.changed_keys)
+
+                if self.journal_size >= self.JOURNAL_COMPACT_SIZE:
+                    self.compact()
+
+            self.changed_keys.clear()
+
+    def encode(self, data):
+        if self.binary:
+            return binary.dumps(data)
 
-            # Write a backup file in case something goes wrong
-            with open(self.file_path + '~', 'w+') as f:
-                f.write(json.dumps(self))
+        return json.dumps(data)
 
-    def save(self):
-        with open(self.file_path, 'w+') as f:
-            f.write(json.dumps(self))
+    def decode(self, contents):
+        if not contents:
+            return {}
+        if binary.is_binary_data(contents):
+            return binary.loads(contents, self.date_format)
+
+        return json.loads(contents)
+
+    def close(self):
+        self.flush()
+
+        if self.compactor:
+            self.compactor.join()
+
+    def compact(self):
+        '''
+        Folds the journal into the main file on a background thread. The thread only
+        works from what is on disk so saves can keep appending to a fresh journal
+        while it runs.
+        '''
+
+        if self.compactor and self.compactor.is_alive():
+            return
+
+        # A leftover journal from an interrupted compaction has to be folded in first,
+        # the current journal will be picked up by the next compaction
+        if not os.path.exists(self.compacting_path):
+            if not os.path.exists(self.journal_path):
+                return
+            os.rename(self.journal_path, self.compacting_path)
+            self.journal_size = 0
+
+        self.compactor = Thread(target=compact_journal, args=(self.file_path, self.compacting_path, self.encode, self.decode, self.fsync))
+        self.compactor.start()
+
+def replay_journal(journal_path, data):
+    '''
+    Applies the records in journal_path to data, returning how many were applied
+    and the size of the journal up to the end of the last one. A partially written
+    last line (e.g. from a crash mid-save) is ignored.
+    '''
+
+    replayed = 0
+    valid_size = 0
+
+    if not os.path.exists(journal_path):
+        return replayed, valid_size
+
+    with open(journal_path, 'rb') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+
+            if len(record) == 2:
+                data[record[0]] = record[1]
+            else:
+                data.pop(record[0], None)
+
+            replayed += 1
+            valid_size += len(line)
+
+    return replayed, valid_size
+
+def compact_journal(file_path, journal_path, encode, decode, fsync=True):
+    with open(file_path, 'rb') as f:
+        data = decode(f.read())
+
+    replay_journal(journal_path, data)
+
+    with atomic_write(file_path, fsync=fsync) as f:
+        f.write(encode(data))
+
+    os.remove(journal_path)
+
+class ScheduledCall(object):
+    def __init__(self, due, call, args, interval=None):
+        self.due = due
+        self.call = call
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+        # Whoever scheduled it through a shared scheduler, so their calls can be cancelled together
+        self.owner = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def advance(self, now):
+        # Skip any runs we're too late for rather than running them back to back
+        self.due += self.interval
+        while self.due <= now:
+            self.due += self.interval
+
+class SchedulingMixin(object):
+    '''
+    call_later() and call_every() for anything with a schedule(ScheduledCall).
+    '''
+
+    def call_later(self, delay, call, *args):
+        return self.schedule(ScheduledCall(time.time() + delay, call, args))
+
+    def call_every(self, interval, call, *args):
+        return self.schedule(ScheduledCall(time.time() + interval, call, args, interval=interval))
+
+class Scheduler(SchedulingMixin, Thread):
+    '''
+    Runs calls at a later time on one long lived thread, where a Timer starts a new
+    thread for each call. Repeating calls are scheduled from when they were due
+    rather than when they ran, so they don't drift later and later.
+
+    Calls run on the scheduler's thread so they should be quick, usually just
+    handing work over to another thread.
+    '''
+
+    def __init__(self):
+        super(Scheduler, self).__init__()
+        self.daemon = True
+        self.calls = []
+        self.call_count = count()
+        self.condition = Condition()
+        self.stopped = False
+
+    def schedule(self, scheduled):
+        with self.condition:
+            heapq.heappush(self.calls, (scheduled.due, next(self.call_count), scheduled))
+            self.condition.notify()
+
+        return scheduled
+
+    def next_call(self):
+        with self.condition:
+            while not self.stopped:
+                if not self.calls:
+                    self.condition.wait()
+                    continue
+
+                due, _, scheduled = self.calls[0]
+                if scheduled.cancelled:
+                    heapq.heappop(self.calls)
+                    continue
+
+                now = time.time()
+                if due > now:
+                    self.condition.wait(due - now)
+                    continue
+
+                heapq.heappop(self.calls)
+
+                if scheduled.interval:
+                    scheduled.advance(now)
+                    heapq.heappush(self.calls, (scheduled.due, next(self.call_count), scheduled))
+
+                return scheduled
+
+    def run(self):
+        while True:
+            scheduled = self.next_call()
+            if scheduled is None:
+                break
+
+            scheduled.call(*scheduled.args)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
 
 class MultiThreadObject(object):
     '''
@@ -43,40 +485,51 @@ class MultiThreadObject(object):
 
     TICK_INTERVAL = 1.0
     PROMPT = ""
+
+    # Lower runs first, calls with the same priority run in the order they were made
+    USER_PRIORITY = 0
+    DEFAULT_PRIORITY = 1
+    TICK_PRIORITY = 2
     COMMANDS = {}
     STOP_COMMAND = 'q'
     DIGIT_COMMAND = ''
 
     def __init__(self):
-        self.main_thread_event = Event()
-        self.main_thread_command = None
-        self.main_thread_args = []
+        self.main_thread_queue = PriorityQueue()
+        self.main_thread_count = count()
+        self.main_thread_lock = Lock()
+        self.coalesced_calls = set()
         self.stopped = False
+        self.tick_interval = self.TICK_INTERVAL
+        self.tick_call = None
+        self.scheduler = self.create_scheduler()
         self.input_thread = Thread(target=self.check_for_input)
 
-        def wrapper():
-            self.__tick__()
-            self.tick_timer = Timer(self.TICK_INTERVAL, wrapper)
-            self.tick_timer.start()
-
-        self.tick_timer = Timer(self.TICK_INTERVAL, wrapper)
+    def create_scheduler(self):
+        return Scheduler()
 
     def start(self):
-        self.tick_timer.start()
+        self.tick_call = self.scheduler.call_every(self.tick_interval, self.__tick__)
+        self.scheduler.start()
         self.input_thread.start()
 
         while True:
-            self.main_thread_event.wait()
-            self.main_thread_command(*self.main_thread_args)
-            self.main_thread_event.clear()
+            _, _, call, args = self.main_thread_queue.get()
+            self.run_main_thread_call(call, args)
 
             if self.stopped:
                 break
 
+    def run_main_thread_call(self, call, args):
+        with self.main_thread_lock:
+            self.coalesced_calls.discard(call)
+
+        call(*args)
+
     def __stop__(self):
         self.stopped = True
         self.input_thread.join()
-        self.tick_timer.cancel()
+        self.scheduler.stop()
 
         self.stop()
 
@@ -84,37 +537,64 @@ class MultiThreadObject(object):
         raise NotImplementedError()
 
     def check_for_input(self):
-        while True:
-            user_input = raw_input(self.PROMPT)
+        while self.handle_input(raw_input(self.PROMPT)):
+            pass
 
-            try:
-                args = [int(user_input)]
-                fn = getattr(self, self.DIGIT_COMMAND)
-            except ValueError:
-                if ' ' in user_input:
-                    command = user_input[:user_input.index(' ')]
-                    # Just take everything passed the first space as a single arg
-                    # should add better parsing for multiple args
-                    args = [user_input[user_input.index(' ') + 1:]]
-                else:
-                    command = user_input
-                    args = None
-
-                if command == self.STOP_COMMAND:
-                    self.execute_on_main_thread(self.__stop__)
-                    break
-                elif command in self.COMMANDS:
-                    fn = getattr(self, self.COMMANDS[command])
-
-            self.execute_on_main_thread(fn, args)
-
-    def execute_on_main_thread(self, call, args=None):
-        self.main_thread_command = call
-        self.main_thread_args = args or []
-        self.main_thread_event.set()
+    def handle_input(self, user_input):
+        '''
+        Queues the command user_input asks for, returning False once it's the stop command.
+        '''
+
+        try:
+            args = [int(user_input)]
+            fn = getattr(self, self.DIGIT_COMMAND)
+        except ValueError:
+            if ' ' in user_input:
+                command = user_input[:user_input.index(' ')]
+                # Just take everything passed the first space as a single arg
+                # should add better parsing for multiple args
+                args = [user_input[user_input.index(' ') + 1:]]
+            else:
+                command = user_input
+                args = None
+
+            if command == self.STOP_COMMAND:
+                self.execute_on_main_thread(self.__stop__, priority=self.USER_PRIORITY)
+                return False
+            elif command in self.COMMANDS:
+                fn = getattr(self, self.COMMANDS[command])
+            else:
+                return True
+
+        self.execute_on_main_thread(fn, args, priority=self.USER_PRIORITY)
+        return True
+
+    def execute_on_main_thread(self, call, args=None, priority=DEFAULT_PRIORITY, coalesce=False):
+        '''
+        Queues call(*args) to run on the main thread, from any thread. With coalesce
+        the call is dropped if the same one is already waiting to run, for things like
+        ticks where running once covers any number of requests.
+        '''
+
+        with self.main_thread_lock:
+            if coalesce:
+                if call in self.coalesced_calls:
+                    return
+                self.coalesced_calls.add(call)
+
+            self.main_thread_queue.put((priority, next(self.main_thread_count), call, args or []))
+
+    def set_tick_interval(self, interval):
+        if interval == self.tick_interval:
+            return
+
+        self.tick_interval = interval
+        if self.tick_call:
+            self.tick_call.cancel()
+            self.tick_call = self.scheduler.call_every(interval, self.__tick__)
 
     def __tick__(self):
-        self.execute_on_main_thread(self.tick)
+        self.execute_on_main_thread(self.tick, priority=self.TICK_PRIORITY, coalesce=True)
 
     def tick(self):
         raise NotImplementedError()
@@ -0,0 +1,164 @@
+'''
+A compact binary encoding for the track DB.
+
+Tracks are grouped by the set of fields they have, which is the same for most of
+a library, and each group is stored a column per field instead of a record per
+track, so field names are stored once per group rather than once per track.
+Columns of STRING_TABLE_FIELDS, which repeat a lot, are stored as numbers into a
+table holding each value once. Dates stay the text they are in the DB, so nothing
+has to be converted either way, and pk is left out when it's the same as
+file_path. The result is pickled, which builds the columns in C, and loading
+turns them back into tracks with zip() and dict().
+'''
+
+import cPickle
+import gc
+import marshal
+from cStringIO import StringIO
+from functools import wraps
+from itertools import izip
+from operator import itemgetter
+
+from .dates import DATE_FIELDS, DateConverter
+
+BINARY_HEADER = 'SPBINARY\x02'
+
+# Written by the first version, which stored each track as a list of field numbers and values
+BINARY_HEADER_V1 = 'SPBINARY\x01'
+
+STRING_TABLE_FIELDS = ['artist', 'album'] + DATE_FIELDS
+
+STRING_TYPES = set([str, unicode])
+
+def without_gc(func):
+    # Encoding and decoding make a lot of containers and no cycles, the garbage collector only slows them down
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    return wrapper
+
+def is_binary_data(data):
+    return data.startswith(BINARY_HEADER) or data.startswith(BINARY_HEADER_V1)
+
+@without_gc
+def dumps(data):
+    string_numbers = {}
+    shapes = {}
+
+    # Tracks with the same fields nearly always have them in the same order too
+    for key, track in data.iteritems():
+        fields = tuple(track)
+        shape = shapes.get(fields)
+        if shape is None:
+            shape = shapes[fields] = ([], [])
+        shape[0].append(key)
+        shape[1].append(track)
+
+    groups = []
+
+    for fields, (keys, tracks) in shapes.iteritems():
+        fields = list(fields)
+        if len(fields) > 1:
+            columns = zip(*map(itemgetter(*fields), tracks))
+        else:
+            columns = [tuple([track[field] for track in tracks]) for field in fields]
+
+        # Keys are nearly always the pk, so they're only stored when one isn't
+        if 'pk' in fields:
+            pks = columns[fields.index('pk')]
+            if tuple(keys) == pks:
+                keys = None
+
+            if 'file_path' in fields and pks == columns[fields.index('file_path')]:
+                del columns[fields.index('pk')]
+                fields.remove('pk')
+
+        tabled = []
+        for i, field in enumerate(fields):
+            if field not in STRING_TABLE_FIELDS:
+                continue
+
+            try:
+                values = set(columns[i])
+            except TypeError:
+                continue
+
+            if set(map(type, values)) <= STRING_TYPES:
+                for value in values:
+                    string_numbers.setdefault(value, len(string_numbers))
+                columns[i] = map(string_numbers.__getitem__, columns[i])
+                tabled.append(i)
+
+        groups.append((fields, keys, columns, tabled))
+
+    strings = [None] * len(string_numbers)
+    for value, number in string_numbers.iteritems():
+        strings[number] = value
+
+    # Without the memo pickling is several times faster, nothing is shared that the string table doesn't cover
+    f = StringIO()
+    f.write(BINARY_HEADER)
+    pickler = cPickle.Pickler(f, 2)
+    pickler.fast = 1
+    pickler.dump((strings, groups))
+
+    return f.getvalue()
+
+@without_gc
+def loads(data, date_format=None):
+    if data.startswith(BINARY_HEADER_V1):
+        return loads_v1(data, date_format)
+
+    strings, groups = cPickle.loads(data[len(BINARY_HEADER):])
+    result = {}
+
+    for fields, keys, columns, tabled in groups:
+        for i in tabled:
+            columns[i] = map(strings.__getitem__, columns[i])
+
+        if 'pk' not in fields and 'file_path' in fields:
+            fields.append('pk')
+            columns.append(columns[fields.index('file_path')])
+
+        if fields:
+            tracks = [dict(izip(fields, values)) for values in izip(*columns)]
+        else:
+            tracks = [{} for _ in keys]
+
+        result.update(izip(keys if keys is not None else columns[fields.index('pk')], tracks))
+
+    return result
+
+def loads_v1(data, date_format):
+    fields, table_fields, strings, records = marshal.loads(data[len(BINARY_HEADER_V1):])
+    date_fields = set(i for i, field in enumerate(fields) if field in DATE_FIELDS)
+    table_fields = set(table_fields)
+    dates = DateConverter(date_format)
+    result = {}
+
+    for key, flat in records:
+        track = {}
+
+        for i in xrange(0, len(flat), 2):
+            number, value = flat[i], flat[i + 1]
+
+            if number in table_fields and isinstance(value, int):
+                value = strings[value]
+            elif number in date_fields and isinstance(value, (int, long)):
+                value = dates.format(value)
+
+            track[fields[number]] = value
+
+        if 'pk' not in track and 'file_path' in track:
+            track['pk'] = track['file_path']
+
+        result[key if key is not None else track['pk']] = track
+
+    return result
@@ -0,0 +1,49 @@
+'''
+Track dates are stored as text in settings.DATE_FORMAT. Everything that needs them
+as numbers (the SQLite DB format, reports, the weighted shuffle) turns them into
+epoch seconds with a DateConverter.
+'''
+
+import calendar
+import datetime
+
+DATE_FIELDS = ['date_added', 'date_played']
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+class DateConverter(object):
+    '''
+    Converts dates in date_format to epoch seconds and back. Libraries share a lot
+    of dates (everything added by one init) so each conversion is remembered.
+
+    Dates are taken to be UTC, which keeps the conversion exact both ways. now()
+    gives the local time the same way, so it compares with dates that were written
+    in local time.
+    '''
+
+    def __init__(self, date_format):
+        self.date_format = date_format
+        self.timestamps = {}
+        self.dates = {}
+
+    def __call__(self, value):
+        '''
+        Returns the epoch seconds of value, raising ValueError if it isn't a date
+        in date_format.
+        '''
+
+        if value not in self.timestamps:
+            self.timestamps[value] = calendar.timegm(datetime.datetime.strptime(value, self.date_format).timetuple())
+
+        return self.timestamps[value]
+
+    def format(self, timestamp):
+        timestamp = int(timestamp)
+
+        if timestamp not in self.dates:
+            self.dates[timestamp] = unicode((EPOCH + datetime.timedelta(seconds=timestamp)).strftime(self.date_format))
+
+        return self.dates[timestamp]
+
+    def now(self):
+        return calendar.timegm(datetime.datetime.now().timetuple())
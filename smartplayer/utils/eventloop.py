@@ -0,0 +1,273 @@
+'''
+A single threaded runtime for MultiThreadObject.
+
+Python 2 has no asyncio, so this is a small select() based loop of the same shape:
+timed calls, callbacks for readable file descriptors and call_soon() for handing
+work over from other threads. Everything runs on the thread that called run(), so
+several objects can share one loop, each through its own EventLoopClient. The loop
+runs until it's stopped or nothing is left registered on it. select() can only wait
+on sockets on Windows, so this needs a POSIX system.
+'''
+
+import errno
+import heapq
+import os
+import select
+import sys
+import time
+from collections import deque
+from itertools import count
+from Queue import Empty
+from threading import Lock
+
+from . import SchedulingMixin
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class EventLoop(SchedulingMixin):
+
+    def __init__(self):
+        self.calls = []
+        self.call_count = count()
+        self.ready = deque()
+        self.readers = {}
+        self.lock = Lock()
+        self.running = False
+
+        # Writing to the pipe wakes select() up when another thread adds work
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        if fcntl:
+            fcntl.fcntl(self.wakeup_write, fcntl.F_SETFL, fcntl.fcntl(self.wakeup_write, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_write, '.')
+        except OSError, e:
+            # A full pipe will wake it up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def schedule(self, scheduled):
+        with self.lock:
+            heapq.heappush(self.calls, (scheduled.due, next(self.call_count), scheduled))
+        self.wakeup()
+
+        return scheduled
+
+    def call_soon(self, call, *args):
+        '''
+        Runs call(*args) on the loop's thread as soon as possible, safe from any thread.
+        '''
+
+        with self.lock:
+            self.ready.append((call, args))
+        self.wakeup()
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+        self.wakeup()
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def cancel_calls(self, owner):
+        with self.lock:
+            for _, _, scheduled in self.calls:
+                if scheduled.owner is owner:
+                    scheduled.cancel()
+        self.wakeup()
+
+    def idle(self):
+        # timeout() has already dropped any cancelled calls from the front
+        with self.lock:
+            return not (self.readers or self.calls or self.ready)
+
+    def timeout(self):
+        with self.lock:
+            while self.calls and self.calls[0][2].cancelled:
+                heapq.heappop(self.calls)
+
+            if self.ready:
+                return 0
+            if self.calls:
+                return max(self.calls[0][0] - time.time(), 0)
+
+        return None
+
+    def run_due_calls(self):
+        now = time.time()
+        due = []
+
+        with self.lock:
+            while self.calls and self.calls[0][0] <= now:
+                _, _, scheduled = heapq.heappop(self.calls)
+                if scheduled.cancelled:
+                    continue
+
+                due.append(scheduled)
+                if scheduled.interval:
+                    scheduled.advance(now)
+                    heapq.heappush(self.calls, (scheduled.due, next(self.call_count), scheduled))
+
+            ready, self.ready = self.ready, deque()
+
+        for scheduled in due:
+            scheduled.call(*scheduled.args)
+
+        for call, args in ready:
+            call(*args)
+
+    def run(self):
+        self.running = True
+
+        while self.running:
+            timeout = self.timeout()
+            if self.idle():
+                break
+
+            try:
+                readable, _, _ = select.select([self.wakeup_read] + self.readers.keys(), [], [], timeout)
+            except select.error:
+                # Interrupted by a signal
+                continue
+
+            for fd in readable:
+                if fd == self.wakeup_read:
+                    os.read(fd, 4096)
+                elif fd in self.readers:
+                    self.readers[fd](fd)
+
+            self.run_due_calls()
+
+        self.running = False
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+
+_default_loop = None
+
+def get_event_loop():
+    global _default_loop
+
+    if _default_loop is None:
+        _default_loop = EventLoop()
+
+    return _default_loop
+
+class EventLoopClient(SchedulingMixin):
+    '''
+    One object's use of a shared EventLoop. It remembers the readers it added and
+    marks the calls it scheduled as its own, so close() can take them all off the
+    loop without touching anyone else's.
+    '''
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.readers = set()
+
+    @property
+    def running(self):
+        return self.loop.running
+
+    def run(self):
+        self.loop.run()
+
+    def schedule(self, scheduled):
+        scheduled.owner = self
+        return self.loop.schedule(scheduled)
+
+    def call_soon(self, call, *args):
+        self.loop.call_soon(call, *args)
+
+    def add_reader(self, fd, callback):
+        self.readers.add(fd)
+        self.loop.add_reader(fd, callback)
+
+    def remove_reader(self, fd):
+        self.readers.discard(fd)
+        self.loop.remove_reader(fd)
+
+    def close(self):
+        for fd in list(self.readers):
+            self.remove_reader(fd)
+
+        self.loop.cancel_calls(self)
+
+class EventLoopMixin(object):
+    '''
+    Mix in ahead of a MultiThreadObject subclass to run it on the shared EventLoop
+    instead of its own threads. Ticks, scheduled calls and commands typed on stdin
+    all run on the loop's thread, other threads can still use
+    execute_on_main_thread(). Stopping one of these only takes its own readers and
+    calls off the loop, which keeps running for as long as anything else is on it.
+    '''
+
+    def create_scheduler(self):
+        return EventLoopClient(get_event_loop())
+
+    def start(self):
+        self.input_buffer = ''
+        self.tick_call = self.scheduler.call_every(self.tick_interval, self.__tick__)
+        self.scheduler.add_reader(sys.stdin.fileno(), self.read_input)
+
+        sys.stdout.write(self.PROMPT)
+        sys.stdout.flush()
+
+        if not self.scheduler.running:
+            self.scheduler.run()
+
+    def read_input(self, fd):
+        data = os.read(fd, 4096)
+
+        # End of input stops us just like the stop command
+        if not data:
+            data = self.STOP_COMMAND + '\n'
+
+        self.input_buffer += data
+
+        while '\n' in self.input_buffer:
+            line, self.input_buffer = self.input_buffer.split('\n', 1)
+
+            if not self.handle_input(line.rstrip('\r')):
+                self.scheduler.remove_reader(fd)
+                break
+
+            sys.stdout.write(self.PROMPT)
+            sys.stdout.flush()
+
+    def execute_on_main_thread(self, call, args=None, priority=None, coalesce=False):
+        if priority is None:
+            priority = self.DEFAULT_PRIORITY
+
+        with self.main_thread_lock:
+            if coalesce:
+                if call in self.coalesced_calls:
+                    return
+                self.coalesced_calls.add(call)
+
+            self.main_thread_queue.put((priority, next(self.main_thread_count), call, args or []))
+
+        # Each of these runs whichever waiting call comes first, so calls that pile up
+        # while the loop is busy still run in priority order
+        self.scheduler.call_soon(self.run_next_main_thread_call)
+
+    def run_next_main_thread_call(self):
+        if self.stopped:
+            return
+
+        try:
+            _, _, call, args = self.main_thread_queue.get_nowait()
+        except Empty:
+            return
+
+        self.run_main_thread_call(call, args)
+
+    def __stop__(self):
+        self.stopped = True
+        self.scheduler.close()
+
+        self.stop()
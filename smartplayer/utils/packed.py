@@ -0,0 +1,182 @@
+import json
+import mmap
+import os
+import struct
+from collections import MutableMapping
+from itertools import izip
+from threading import RLock
+
+from . import DelayedSaveMixin, TrackedDict, atomic_write, backup_file
+
+PACKED_HEADER = 'SPTRACKS\x02'
+
+# Written by the first version, which had a JSON index of {key: [offset, length]}
+PACKED_HEADER_V1 = 'SPTRACKS\x01'
+
+# Where the offset table starts and how many entries there are
+FOOTER_FORMAT = '<QQ'
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+FOOTER_FORMAT_V1 = '<Q'
+
+class PackedDict(DelayedSaveMixin, MutableMapping):
+    '''
+    Same interface as PersistedDict but loaded lazily from a memory-mapped file.
+
+    The file is the header, each entry encoded as JSON one after another, a table
+    of where each entry starts (and where the last one ends) as 64-bit offsets,
+    the keys as UTF-8 separated by NULs and finally the table's offset and the
+    number of entries. Opening only reads the table and the keys, an entry is
+    parsed the first time it is looked up. Writing rewrites the file but copies
+    the bytes of every entry that didn't change straight across instead of
+    encoding them again.
+    '''
+
+    def __init__(self, file_path, overwrite=False, save_delay=0, fsync=True, backups=1):
+        self.file_path = os.path.abspath(os.path.expanduser(file_path))
+        self.changed_keys = set()
+        self.cache = {}
+        self.index = {}
+        self.offsets = ()
+        self.mapped = None
+        self.save_delay = save_delay
+        self.save_timer = None
+        self.lock = RLock()
+        self.needs_snapshot = overwrite or not os.path.exists(self.file_path)
+        self.fsync = fsync
+
+        if not overwrite:
+            # The file is only ever replaced, never written in place, so linking is safe
+            backup_file(self.file_path, backups)
+            self.read_from_file()
+
+    def read_from_file(self):
+        if not os.path.exists(self.file_path) or not os.path.getsize(self.file_path):
+            return
+
+        with open(self.file_path, 'rb') as f:
+            self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mapped[:len(PACKED_HEADER_V1)] == PACKED_HEADER_V1:
+            index_offset, = struct.unpack(FOOTER_FORMAT_V1, self.mapped[-struct.calcsize(FOOTER_FORMAT_V1):])
+            index = json.loads(self.mapped[index_offset:-struct.calcsize(FOOTER_FORMAT_V1)])
+            keys = index.keys()
+            self.offsets = []
+            for offset, length in index.itervalues():
+                self.offsets.extend((offset, offset + length))
+            self.index = dict((key, 2 * i) for i, key in enumerate(keys))
+            return
+
+        table_offset, count = struct.unpack(FOOTER_FORMAT, self.mapped[-FOOTER_SIZE:])
+        keys_offset = table_offset + 8 * (count + 1)
+        self.offsets = struct.unpack('<%dQ' % (count + 1), self.mapped[table_offset:keys_offset])
+        keys = self.mapped[keys_offset:-FOOTER_SIZE].decode('utf-8').split(u'\0') if count else []
+        self.index = dict(izip(keys, xrange(count)))
+
+    def raw(self, key):
+        i = self.index[key]
+        return self.mapped[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+            if key in self.changed_keys or key not in self.index:
+                raise KeyError(key)
+
+            self.cache[key] = TrackedDict(self, key, json.loads(self.raw(key)))
+            return self.cache[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.cache[key] = TrackedDict(self, key, value)
+            self.changed_keys.add(key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+
+            self.cache.pop(key, None)
+            self.changed_keys.add(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.cache:
+                return True
+
+            return key in self.index and key not in self.changed_keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return [key for key in self.index if key not in self.changed_keys] + [key for key in self.cache if key in self.changed_keys]
+
+    def itervalues(self):
+        '''
+        Yields every entry without holding on to the ones that haven't been looked up,
+        for read only passes over the whole DB.
+        '''
+
+        for key in self.keys():
+            with self.lock:
+                if key in self.cache:
+                    value = self.cache[key]
+                elif key in self.index:
+                    value = json.loads(self.raw(key))
+                else:
+                    continue
+
+            yield value
+
+    def flush(self):
+        with self.lock:
+            self.cancel_delayed_save()
+
+            if not (self.changed_keys or self.needs_snapshot):
+                return
+
+            try:
+                self.write(self.keys())
+            except:
+                # Writing failed part way, keep reading from the old file
+                if self.mapped is None:
+                    self.read_from_file()
+                raise
+
+            self.read_from_file()
+            self.changed_keys.clear()
+            self.needs_snapshot = False
+
+    def write(self, keys):
+        offsets = []
+
+        with atomic_write(self.file_path, fsync=self.fsync) as f:
+            f.write(PACKED_HEADER)
+
+            for key in keys:
+                offsets.append(f.tell())
+                f.write(json.dumps(self.cache[key]) if key in self.changed_keys else self.raw(key))
+            offsets.append(f.tell())
+
+            table_offset = f.tell()
+            f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+            f.write(u'\0'.join(keys).encode('utf-8'))
+            f.write(struct.pack(FOOTER_FORMAT, table_offset, len(keys)))
+
+            # The mapped file can't be replaced on Windows while it's still open
+            if self.mapped:
+                self.mapped.close()
+                self.mapped = None
+
+    def close(self):
+        self.flush()
+
+        with self.lock:
+            if self.mapped:
+                self.mapped.close()
+                self.mapped = None
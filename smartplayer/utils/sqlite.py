@@ -0,0 +1,265 @@
+import json
+import os
+import shutil
+import sqlite3
+from collections import MutableMapping
+from threading import RLock
+
+from . import DelayedSaveMixin, TrackedDict, rotate_backups
+from .dates import DATE_FIELDS, DateConverter
+
+SQLITE_HEADER = 'SQLite format 3\x00'
+
+class SqliteDict(DelayedSaveMixin, MutableMapping):
+    '''
+    Same interface as PersistedDict but backed by a SQLite database, so a save only
+    writes the rows that changed.
+
+    Each entry is kept as a JSON blob plus a copy of INDEXED_FIELDS in their own
+    indexed columns (dates as epoch seconds) which select() can filter and sort on.
+    Entries that have been read are cached, so like PersistedDict the same dict
+    is handed back each time and can be edited in place.
+
+    SQLite writes in place, so rather than copying the file on every open the DB is
+    backed up from SQLite's side just before the first write of each session.
+    '''
+
+    INDEXED_FIELDS = ['rating', 'listen_count', 'skip_count', 'date_added', 'date_played', 'artist', 'album']
+
+    # Names have to stay text, with numeric affinity an artist like '1999' would be stored as a number
+    COLUMN_TYPES = {
+        'rating': 'NUMERIC',
+        'listen_count': 'NUMERIC',
+        'skip_count': 'NUMERIC',
+        'date_added': 'INTEGER',
+        'date_played': 'INTEGER',
+        'artist': 'TEXT',
+        'album': 'TEXT',
+    }
+
+    def __init__(self, file_path, overwrite=False, save_delay=0, date_format=None, fsync=True, backups=1):
+        self.file_path = os.path.abspath(os.path.expanduser(file_path))
+        self.date_format = date_format
+        self.dates = DateConverter(date_format) if date_format else None
+        self.changed_keys = set()
+        self.cache = {}
+        self.save_delay = save_delay
+        self.save_timer = None
+        self.lock = RLock()
+        self.backups = backups
+        self.backed_up = overwrite or not os.path.exists(self.file_path)
+
+        if overwrite and os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+        # Delayed saves flush from a timer thread, self.lock guards the connection
+        self.connection = sqlite3.connect(self.file_path, check_same_thread=False)
+        if not fsync:
+            self.connection.execute("PRAGMA synchronous = OFF")
+        self.create_tables()
+
+    def create_tables(self):
+        columns = ', '.join('%s %s' % (field, self.COLUMN_TYPES[field]) for field in self.INDEXED_FIELDS)
+
+        # DBs made before the columns had these types are rebuilt from the JSON, which still has every value as it was
+        types = dict((row[1], row[2]) for row in self.connection.execute("PRAGMA table_info(tracks)"))
+        rebuild = types and any(types.get(field) != self.COLUMN_TYPES[field] for field in self.INDEXED_FIELDS)
+        if rebuild and not self.backed_up:
+            self.backup()
+
+        with self.connection:
+            rows = []
+            if rebuild:
+                rows = self.connection.execute("SELECT pk, data FROM tracks").fetchall()
+                self.connection.execute("DROP TABLE tracks")
+
+            self.connection.execute("CREATE TABLE IF NOT EXISTS tracks (pk TEXT PRIMARY KEY, data TEXT NOT NULL, %s)" % columns)
+            for key, data in rows:
+                self.insert(key, json.loads(data))
+
+            self.connection.execute("CREATE TABLE IF NOT EXISTS track_groups (pk TEXT NOT NULL, name TEXT NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS track_groups_name ON track_groups (name)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS track_groups_pk ON track_groups (pk)")
+            for field in self.INDEXED_FIELDS:
+                self.connection.execute("CREATE INDEX IF NOT EXISTS tracks_%s ON tracks (%s)" % (field, field))
+
+    def column_value(self, field, value):
+        if value is not None and field in DATE_FIELDS and self.dates:
+            value = self.dates(value)
+
+        return value
+
+    def insert(self, key, track):
+        values = [key, json.dumps(track)] + [self.column_value(field, track.get(field)) for field in self.INDEXED_FIELDS]
+        self.connection.execute("INSERT OR REPLACE INTO tracks (pk, data, %s) VALUES (%s)" % (', '.join(self.INDEXED_FIELDS), ', '.join('?' * len(values))), values)
+
+    def load(self, key, data):
+        if key not in self.cache:
+            self.cache[key] = TrackedDict(self, key, json.loads(data))
+
+        return self.cache[key]
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+
+            row = self.connection.execute("SELECT data FROM tracks WHERE pk = ?", (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+
+            return self.load(key, row[0])
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.cache[key] = TrackedDict(self, key, value)
+            self.changed_keys.add(key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+
+            self.cache.pop(key, None)
+            self.changed_keys.add(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.cache:
+                return True
+            if key in self.changed_keys:
+                return False
+
+            return self.connection.execute("SELECT 1 FROM tracks WHERE pk = ?", (key,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        with self.lock:
+            keys = set(row[0] for row in self.connection.execute("SELECT pk FROM tracks"))
+            keys.update(self.cache)
+            keys.difference_update(key for key in self.changed_keys if key not in self.cache)
+
+            return list(keys)
+
+    def values(self):
+        with self.lock:
+            for key, data in self.connection.execute("SELECT pk, data FROM tracks"):
+                if key not in self.changed_keys:
+                    self.load(key, data)
+
+            return self.cache.values()
+
+    def itervalues(self):
+        # Rows are fetched up front so the connection is free again while they're worked through
+        with self.lock:
+            rows = self.connection.execute("SELECT pk, data FROM tracks").fetchall()
+
+        for key, data in rows:
+            if key in self.cache:
+                yield self.cache[key]
+            elif key not in self.changed_keys:
+                yield json.loads(data)
+
+    def items(self):
+        with self.lock:
+            self.values()
+            return self.cache.items()
+
+    def select(self, field, default=None, reverse=False, min_value=None, max_value=None, limit=None, group=None):
+        '''
+        Returns the entries ordered by one of the INDEXED_FIELDS, letting SQLite do the
+        filtering, sorting and limiting. Entries without the field are treated as
+        having the value default. Passing group only returns entries in that group.
+        Unsaved changes are flushed first.
+        '''
+
+        if field not in self.INDEXED_FIELDS:
+            raise ValueError("Cannot select by unindexed field '%s'" % field)
+
+        column = "COALESCE(%s, ?)" % field
+        params = [self.column_value(field, default)]
+        conditions = []
+
+        if min_value is not None:
+            conditions.append("%s >= ?" % column)
+            params.extend([self.column_value(field, default), self.column_value(field, min_value)])
+        if max_value is not None:
+            conditions.append("%s <= ?" % column)
+            params.extend([self.column_value(field, default), self.column_value(field, max_value)])
+        if group is not None:
+            conditions.append("pk IN (SELECT pk FROM track_groups WHERE name = ?)")
+            params.append(group)
+
+        query = "SELECT pk, data, %s AS value FROM tracks" % column
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY value %s" % ('DESC' if reverse else 'ASC')
+        if limit:
+            query += " LIMIT %d" % limit
+
+        self.flush()
+
+        with self.lock:
+            return [self.load(key, data) for key, data, _ in self.connection.execute(query, params)]
+
+    def flush(self):
+        with self.lock:
+            self.cancel_delayed_save()
+
+            if not self.changed_keys:
+                return
+
+            if not self.backed_up:
+                self.backup()
+
+            with self.connection:
+                for key in self.changed_keys:
+                    self.connection.execute("DELETE FROM track_groups WHERE pk = ?", (key,))
+
+                    if key not in self.cache:
+                        self.connection.execute("DELETE FROM tracks WHERE pk = ?", (key,))
+                        continue
+
+                    track = self.cache[key]
+                    self.insert(key, track)
+                    self.connection.executemany("INSERT INTO track_groups (pk, name) VALUES (?, ?)", [(key, name) for name in track.get('groups', [])])
+
+            self.changed_keys.clear()
+
+    def backup(self):
+        '''
+        Writes a backup of the DB as it is now, once per session. VACUUM INTO writes
+        one from a consistent snapshot of the DB. Older SQLite doesn't have it, so
+        the file is copied instead, after folding any WAL into it and while holding
+        the write lock so nothing can change it part way through.
+        '''
+
+        self.backed_up = True
+        if not self.backups:
+            return
+
+        backup_path = rotate_backups(self.file_path, self.backups)
+
+        if sqlite3.sqlite_version_info >= (3, 27):
+            self.connection.execute("VACUUM INTO ?", (backup_path,))
+            return
+
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Reading first rolls back anything a crashed writer left half done
+            self.connection.execute("SELECT COUNT(*) FROM tracks").fetchone()
+            shutil.copyfile(self.file_path, backup_path)
+        finally:
+            self.connection.rollback()
+
+    def close(self):
+        self.flush()
+
+        with self.lock:
+            self.connection.close()
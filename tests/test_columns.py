@@ -0,0 +1,29 @@
+import unittest
+
+from smartplayer.reporting.columns import TrackColumns
+
+class TrackColumnsTest(unittest.TestCase):
+    def setUp(self):
+        # Every artist has the same total, so only the tie breaking decides the order
+        self.tracks = [{'pk': i, 'artist': artist, 'rating': 1} for i, artist in enumerate('dbeacfdbeacf')]
+
+    def grouped(self, tracks):
+        columns = TrackColumns.load(tracks, 'rating', int, default=0, group_by=['artist'])
+        return columns.aggregate('sum', lambda key, value: {'artist': key[0], 'rating': value})
+
+    def test_groups_are_in_key_order(self):
+        rows = self.grouped(self.tracks).select(reverse=True)
+        self.assertEqual([row['artist'] for row in rows], list('abcdef'))
+
+    def test_limited_ties_dont_depend_on_track_order(self):
+        for tracks in (self.tracks, list(reversed(self.tracks))):
+            for reverse in (True, False):
+                rows = self.grouped(tracks).select(reverse=reverse, limit=3)
+                self.assertEqual([row['artist'] for row in rows], list('abc'))
+
+    def test_limited_ties_keep_load_order(self):
+        columns = TrackColumns.load(self.tracks, 'rating', int)
+        self.assertEqual([track['pk'] for track in columns.select(reverse=True, limit=4)], [0, 1, 2, 3])
+
+if __name__ == '__main__':
+    unittest.main()
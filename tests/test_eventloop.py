@@ -0,0 +1,70 @@
+import unittest
+
+from smartplayer.utils import MultiThreadObject
+from smartplayer.utils.eventloop import EventLoop, EventLoopClient, EventLoopMixin
+
+class EventLoopClientTest(unittest.TestCase):
+    def test_closing_one_client_leaves_the_others(self):
+        loop = EventLoop()
+        first = EventLoopClient(loop)
+        second = EventLoopClient(loop)
+        ticks = []
+        fired = []
+
+        first.call_every(0.01, ticks.append, 'tick')
+        first.call_later(0.03, first.close)
+        second.call_later(0.1, lambda: fired.append(len(ticks)))
+
+        # Returns by itself once nothing is left on the loop
+        loop.run()
+
+        # The first client's ticks stopped when it closed, well before the second's call
+        self.assertEqual(fired, [len(ticks)])
+        self.assertTrue(0 < len(ticks) < 5)
+        self.assertTrue(loop.idle())
+
+class Runner(EventLoopMixin, MultiThreadObject):
+    def __init__(self, loop):
+        self.loop = loop
+        super(Runner, self).__init__()
+        self.calls = []
+
+    def record(self, name):
+        self.calls.append(name)
+
+    def create_scheduler(self):
+        return EventLoopClient(self.loop)
+
+    def stop(self):
+        pass
+
+class EventLoopMixinTest(unittest.TestCase):
+    def test_waiting_calls_run_in_priority_order(self):
+        runner = Runner(EventLoop())
+
+        def queue_calls():
+            runner.execute_on_main_thread(runner.record, ['tick'], priority=runner.TICK_PRIORITY)
+            runner.execute_on_main_thread(runner.record, ['default'])
+            runner.execute_on_main_thread(runner.record, ['user'], priority=runner.USER_PRIORITY)
+
+        runner.scheduler.call_soon(queue_calls)
+        runner.loop.run()
+
+        self.assertEqual(runner.calls, ['user', 'default', 'tick'])
+
+    def test_stop_only_takes_its_own_calls_off(self):
+        loop = EventLoop()
+        runner = Runner(loop)
+        other = EventLoopClient(loop)
+        fired = []
+
+        runner.tick_call = runner.scheduler.call_every(0.01, runner.record, 'tick')
+        runner.scheduler.call_later(0.02, runner.execute_on_main_thread, runner.__stop__)
+        other.call_later(0.05, fired.append, True)
+        loop.run()
+
+        self.assertTrue(runner.stopped)
+        self.assertEqual(fired, [True])
+
+if __name__ == '__main__':
+    unittest.main()
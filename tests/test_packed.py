@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from smartplayer.utils.packed import PackedDict
+
+class PackedDictTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, '.tracks')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_new_empty_db_is_written(self):
+        PackedDict(self.file_path).close()
+        self.assertTrue(os.path.exists(self.file_path))
+        self.assertEqual(len(PackedDict(self.file_path)), 0)
+
+    def test_changes_survive_reopening(self):
+        db = PackedDict(self.file_path)
+        for i in range(5):
+            db[u'track %d' % i] = {'rating': i}
+        db[u'Bj\xf6rk'] = {'rating': 10}
+        db.close()
+
+        db = PackedDict(self.file_path)
+        db[u'track 1']['rating'] = 11
+        self.assertEqual(db[u'track 2']['rating'], 2)
+        del db[u'track 3']
+        db[u'track 5'] = {'rating': 5}
+        db.close()
+
+        db = PackedDict(self.file_path)
+        self.assertEqual(dict((key, value['rating']) for key, value in db.items()),
+                         {u'track 0': 0, u'track 1': 11, u'track 2': 2, u'track 4': 4, u'track 5': 5, u'Bj\xf6rk': 10})
+        self.assertFalse(os.path.exists(self.file_path + '.tmp'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from smartplayer.utils import PersistedDict
+
+class PersistedDictTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, '.tracks')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_snapshot_replaces_journal(self):
+        db = PersistedDict(self.file_path, journal=True)
+        db['a'] = {'rating': 1}
+        db.flush()
+        db['a']['rating'] = 2
+        db.close()
+        self.assertTrue(os.path.exists(self.file_path + '.journal'))
+
+        # Without the journal every save is a snapshot, which an old journal mustn't undo
+        db = PersistedDict(self.file_path, journal=False)
+        db['a']['rating'] = 3
+        db.close()
+        self.assertFalse(os.path.exists(self.file_path + '.journal'))
+
+        db = PersistedDict(self.file_path, journal=True)
+        self.assertEqual(db['a']['rating'], 3)
+
+    def test_new_empty_db_is_written(self):
+        PersistedDict(self.file_path).close()
+        self.assertTrue(os.path.exists(self.file_path))
+
+if __name__ == '__main__':
+    unittest.main()
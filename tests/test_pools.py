@@ -0,0 +1,48 @@
+import random
+import unittest
+
+from smartplayer.players.pools import WeightedTrackPool
+
+class WeightedTrackPoolTest(unittest.TestCase):
+    PICKS = 40000
+
+    def setUp(self):
+        random.seed(0)
+
+    def make_pool(self, count):
+        pool = WeightedTrackPool(lambda track: 1.0)
+        for pk in range(count):
+            pool[pk] = {'pk': pk}
+        return pool
+
+    def assertEvenPicks(self, pool):
+        picks = dict((pk, 0) for pk in pool)
+        for _ in xrange(self.PICKS):
+            picks[pool.choice()['pk']] += 1
+
+        expected = float(self.PICKS) / len(picks)
+        for pk, count in picks.iteritems():
+            self.assertTrue(0.75 * expected < count < 1.25 * expected, "track %s picked %d times, expected about %d" % (pk, count, expected))
+
+    def test_picks_evenly_after_growing(self):
+        # 40 tracks makes the tree grow past 16 and 32 entries
+        pool = self.make_pool(40)
+        self.assertTrue(len(pool.tree) - 1 > len(pool))
+        self.assertEqual(pool.total(), 40.0)
+        self.assertEvenPicks(pool)
+
+    def test_picks_evenly_after_refresh(self):
+        pool = self.make_pool(40)
+        pool.refresh()
+        self.assertEqual(pool.total(), 40.0)
+        self.assertEvenPicks(pool)
+
+    def test_picks_evenly_after_removing(self):
+        pool = self.make_pool(40)
+        for pk in range(0, 40, 3):
+            del pool[pk]
+        pool.refresh()
+        self.assertEvenPicks(pool)
+
+if __name__ == '__main__':
+    unittest.main()
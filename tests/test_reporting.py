@@ -0,0 +1,33 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from smartplayer.reporting import report_by_rating
+from smartplayer.tracks import open_track_db
+
+class ReportByTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'album'))
+
+        db = open_track_db(os.path.join(self.directory, '.tracks'), backend='json')
+        for name, rating in (('low', -10), ('high', 10)):
+            file_path = os.path.join('album', name + '.mp3')
+            open(os.path.join(self.directory, file_path), 'w').close()
+            db[file_path] = {'pk': file_path, 'file_path': file_path, 'rating': rating}
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_delete_from_subdirectory(self):
+        # File paths are relative to the DB, which is found above the given path
+        report_by_rating(os.path.join(self.directory, 'album'), max_threshold='0', delete=True)
+
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'album', 'low.mp3')))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'album', 'high.mp3')))
+        self.assertEqual(list(open_track_db(os.path.join(self.directory, '.tracks'))), [os.path.join('album', 'high.mp3')])
+
+if __name__ == '__main__':
+    unittest.main()
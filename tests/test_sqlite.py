@@ -0,0 +1,43 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from smartplayer.utils.sqlite import SqliteDict
+
+class SqliteDictTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, '.tracks')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def column_types(self, db):
+        return db.connection.execute("SELECT typeof(artist), album, typeof(rating) FROM tracks").fetchall()
+
+    def test_names_are_stored_as_text(self):
+        db = SqliteDict(self.file_path)
+        db['a'] = {'pk': 'a', 'artist': '1999', 'album': '007', 'rating': 5}
+        db.flush()
+
+        self.assertEqual(self.column_types(db), [('text', '007', 'integer')])
+        self.assertEqual([track['pk'] for track in db.select('artist', min_value='1999', max_value='1999')], ['a'])
+
+    def test_numeric_name_columns_are_rebuilt(self):
+        connection = sqlite3.connect(self.file_path)
+        connection.execute("CREATE TABLE tracks (pk TEXT PRIMARY KEY, data TEXT NOT NULL, rating NUMERIC, listen_count NUMERIC, "
+                           "skip_count NUMERIC, date_added INTEGER, date_played INTEGER, artist NUMERIC, album NUMERIC)")
+        track = {'pk': 'a', 'artist': '1999', 'album': '007', 'rating': 5}
+        connection.execute("INSERT INTO tracks (pk, data, rating, artist, album) VALUES (?, ?, ?, ?, ?)", ('a', json.dumps(track), 5, '1999', '007'))
+        connection.commit()
+        connection.close()
+
+        db = SqliteDict(self.file_path)
+        self.assertEqual(self.column_types(db), [('text', '007', 'integer')])
+        self.assertEqual(db['a'], track)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from smartplayer.tracks.watch import PollingWatcher, ADDED, MOVED, REMOVED
+
+class PollingWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.events = []
+
+        os.mkdir(os.path.join(self.root, 'Album'))
+        for name in ('1.mp3', '2.mp3'):
+            open(os.path.join(self.root, 'Album', name), 'w').close()
+
+        # Make sure the changes below give the directories a different mtime
+        os.utime(self.root, (0, 0))
+        os.utime(os.path.join(self.root, 'Album'), (0, 0))
+
+        self.watcher = PollingWatcher(self.root, ['mp3'], lambda *event: self.events.append(event))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_renamed_directory_is_moved(self):
+        os.rename(os.path.join(self.root, 'Album'), os.path.join(self.root, 'Renamed'))
+        self.watcher.poll()
+
+        self.assertEqual(sorted(self.events), [
+            (MOVED, os.path.join(self.root, 'Renamed', name), os.path.join(self.root, 'Album', name)) for name in ('1.mp3', '2.mp3')
+        ])
+
+    def test_file_moved_into_new_directory_is_moved(self):
+        os.mkdir(os.path.join(self.root, 'New'))
+        os.rename(os.path.join(self.root, 'Album', '1.mp3'), os.path.join(self.root, 'New', '1.mp3'))
+        self.watcher.poll()
+
+        self.assertEqual(self.events, [(MOVED, os.path.join(self.root, 'New', '1.mp3'), os.path.join(self.root, 'Album', '1.mp3'))])
+
+    def test_new_and_removed_files(self):
+        open(os.path.join(self.root, 'Album', '3.mp3'), 'w').close()
+        os.remove(os.path.join(self.root, 'Album', '1.mp3'))
+        self.watcher.poll()
+
+        self.assertEqual(sorted(self.events), [
+            (ADDED, os.path.join(self.root, 'Album', '3.mp3'), None),
+            (REMOVED, os.path.join(self.root, 'Album', '1.mp3'), None),
+        ])
+
+if __name__ == '__main__':
+    unittest.main()